@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+"asyncio version of the pyspeedtest measurements, speaking HTTP/1.1 over asyncio streams"
+
+import asyncio
+import heapq
+import logging
+import platform
+import re
+
+from time import time
+from xml.etree import ElementTree
+
+from pyspeedtest import SpeedTest, distance, payload, randint
+
+LOG = logging.getLogger('pyspeedtest')
+
+
+class HTTPStream(object):
+    """One keep-alive HTTP/1.1 connection. Every connect and request is
+    limited to timeout seconds."""
+
+    def __init__(self, host, timeout):
+        self.host = host
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+
+    async def open(self):
+        hostname, _, port = self.host.partition(':')
+        try:
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(hostname, int(port or 80)),
+                self.timeout)
+        except (OSError, asyncio.TimeoutError):
+            raise Exception('Unable to connect to %r' % self.host)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    async def request(self, method, path, body=None, headers=None,
+                      progress=None, sink=None):
+        """Send a request and read the response, returning the body size.
+
+        progress, if given, is called with the size of each chunk sent or
+        received, and sink with each chunk of the response body."""
+        return await asyncio.wait_for(
+            self._request(method, path, body, headers or {}, progress, sink),
+            self.timeout)
+
+    async def _request(self, method, path, body, headers, progress, sink):
+        if self.writer is None:
+            await self.open()
+        lines = ['%s %s HTTP/1.1' % (method, path),
+                 'Host: %s' % self.host,
+                 'Connection: keep-alive']
+        if body is not None:
+            lines.append('Content-Length: %d' % len(body))
+        lines.extend('%s: %s' % header for header in headers.items())
+        self.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        if body is not None:
+            body = memoryview(body)
+            for offset in range(0, len(body), SpeedTest.WRITE_CHUNK):
+                chunk = body[offset:offset + SpeedTest.WRITE_CHUNK]
+                self.writer.write(chunk)
+                await self.writer.drain()
+                if progress is not None:
+                    progress(len(chunk))
+        await self.writer.drain()
+
+        status = await self.reader.readline()
+        parts = status.split(None, 2)
+        if len(parts) < 2:
+            raise Exception('Bad response from %r' % self.host)
+        response_headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            response_headers[name.strip().lower()] = value.strip()
+
+        size = await self._readbody(response_headers, progress, sink)
+        if response_headers.get('connection', '').lower() == 'close':
+            self.close()
+        if int(parts[1]) != 200:
+            raise Exception('HTTP %s from %r for %s' % (
+                parts[1].decode('latin-1'), self.host, path))
+        return size
+
+    async def _readbody(self, headers, progress, sink):
+        size = 0
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            while True:
+                length = int((await self.reader.readline()).split(b';')[0], 16)
+                if not length:
+                    break
+                size += await self._readexactly(length, progress, sink)
+                await self.reader.readline()
+            while (await self.reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+        elif 'content-length' in headers:
+            size = await self._readexactly(
+                int(headers['content-length']), progress, sink)
+        else:
+            while True:
+                chunk = await self.reader.read(SpeedTest.READ_BUFFER)
+                if not chunk:
+                    break
+                size += self._received(chunk, progress, sink)
+            self.close()
+        return size
+
+    async def _readexactly(self, length, progress, sink):
+        remaining = length
+        while remaining:
+            chunk = await self.reader.read(min(remaining, SpeedTest.READ_BUFFER))
+            if not chunk:
+                raise Exception('Connection to %r closed early' % self.host)
+            remaining -= self._received(chunk, progress, sink)
+        return length
+
+    def _received(self, chunk, progress, sink):
+        if progress is not None:
+            progress(len(chunk))
+        if sink is not None:
+            sink(chunk)
+        return len(chunk)
+
+
+class NearestServers(object):
+    """Incrementally parse speedtest-servers.php, keeping the count servers
+    nearest to lat/lon."""
+
+    def __init__(self, lat, lon, count):
+        self.lat = lat
+        self.lon = lon
+        self.count = count
+        self.nearest = []
+        self.parser = ElementTree.XMLPullParser()
+
+    def feed(self, chunk):
+        self.parser.feed(chunk)
+        for _, element in self.parser.read_events():
+            if element.tag != 'server':
+                continue
+            try:
+                entry = (-distance(self.lat, self.lon,
+                                   float(element.get('lat')),
+                                   float(element.get('lon'))),
+                         element.get('url'))
+            except (TypeError, ValueError):
+                continue
+            finally:
+                element.clear()
+            if len(self.nearest) < self.count:
+                heapq.heappush(self.nearest, entry)
+            elif entry > self.nearest[0]:
+                heapq.heapreplace(self.nearest, entry)
+
+    def hosts(self):
+        """Return the hosts of the nearest servers, nearest first."""
+        hosts = []
+        for _, url in sorted(self.nearest, reverse=True):
+            match = re.search(r'http://([^/]+)/speedtest/upload\.php', url)
+            if match is not None:
+                hosts.append(match.groups()[0])
+        return hosts
+
+
+class AsyncSpeedTest(object):
+    """Same measurements and results as SpeedTest, run as coroutines."""
+
+    # Seconds allowed for each connect and each request
+    TIMEOUT = 30
+
+    def __init__(self, host=None, runs=2, timeout=None):
+        self.host = host
+        self.runs = runs
+        self.timeout = timeout or self.TIMEOUT
+
+    async def gethost(self):
+        if not self.host:
+            self.host = await self.chooseserver()
+        return self.host
+
+    async def ping(self, server=None, timeout=None):
+        if not server:
+            server = await self.gethost()
+        stream = HTTPStream(server, timeout or self.timeout)
+        try:
+            times = []
+            for _ in range(5):
+                start = time()
+                await stream.request(
+                    'GET', '/speedtest/latency.txt?x=%d' % randint())
+                times.append(time() - start)
+        finally:
+            stream.close()
+        times.remove(max(times))
+        total_ms = sum(times) * 250  # * 1000 / number of tries (4) = 250
+        LOG.debug('Latency for %s - %d', server, total_ms)
+        return total_ms
+
+    async def download(self, runs=None, progress=None):
+        host = await self.gethost()
+        streams = [HTTPStream(host, self.timeout)
+                   for i in range(runs or self.runs)]
+        try:
+            await asyncio.gather(*[stream.open() for stream in streams])
+            total_downloaded = 0
+            total_start_time = time()
+            for current_file in SpeedTest.DOWNLOAD_FILES:
+                sizes = await asyncio.gather(*[
+                    stream.request(
+                        'GET', '%s?x=%d' % (current_file, int(time() * 1000)),
+                        progress=progress)
+                    for stream in streams])
+                total_downloaded += sum(sizes)
+            total_ms = (time() - total_start_time) * 1000
+        finally:
+            for stream in streams:
+                stream.close()
+        LOG.info('Took %d ms to download %d bytes',
+                 total_ms, total_downloaded)
+        return total_downloaded * 8000 / total_ms
+
+    async def upload(self, runs=None, progress=None):
+        host = await self.gethost()
+        streams = [HTTPStream(host, self.timeout)
+                   for i in range(runs or self.runs)]
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+
+        async def post(stream, data):
+            reply = []
+            await stream.request(
+                'POST', '/speedtest/upload.php?x=%d' % randint(), data,
+                headers, progress, reply.append)
+            return int(b''.join(reply).decode('utf-8').split('=')[1])
+
+        try:
+            await asyncio.gather(*[stream.open() for stream in streams])
+            total_uploaded = 0
+            total_start_time = time()
+            for size in SpeedTest.UPLOAD_FILES:
+                data = payload(size)
+                sizes = await asyncio.gather(*[
+                    post(stream, data) for stream in streams])
+                total_uploaded += sum(sizes)
+            total_ms = (time() - total_start_time) * 1000
+        finally:
+            for stream in streams:
+                stream.close()
+        LOG.info('Took %d ms to upload %d bytes',
+                 total_ms, total_uploaded)
+        return total_uploaded * 8000 / total_ms
+
+    async def rankservers(self):
+        """Return the hosts of the nearest servers, lowest latency first."""
+        stream = HTTPStream(SpeedTest.CONFIG_HOST, self.timeout)
+        headers = {
+            'User-Agent': SpeedTest.USER_AGENTS.get(
+                platform.system(), SpeedTest.USER_AGENTS['Linux'])
+        }
+        try:
+            config = []
+            await stream.request(
+                'GET', '/speedtest-config.php?x=%d' % int(time() * 1000),
+                headers=headers, sink=config.append)
+            match = re.search(
+                r'<client ip="([^"]*)" lat="([^"]*)" lon="([^"]*)"',
+                b''.join(config).decode('utf-8'))
+            if match is None:
+                LOG.info('Failed to retrieve coordinates')
+                return []
+            LOG.info('Your IP: %s', match.group(1))
+            nearest = NearestServers(float(match.group(2)),
+                                     float(match.group(3)),
+                                     SpeedTest.CANDIDATES)
+            await stream.request(
+                'GET', '/speedtest-servers.php?x=%d' % int(time() * 1000),
+                headers=headers, sink=nearest.feed)
+        finally:
+            stream.close()
+        return await self.probeservers(nearest.hosts())
+
+    async def probeservers(self, hosts, deadline=None):
+        """Ping all hosts at once, returning those that answered within
+        deadline seconds, lowest latency first."""
+        deadline = deadline or SpeedTest.PROBE_DEADLINE
+        probes = dict(
+            (asyncio.ensure_future(self.ping(host, deadline)), host)
+            for host in hosts)
+        if not probes:
+            return []
+        done, pending = await asyncio.wait(probes, timeout=deadline)
+        for probe in pending:
+            probe.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        ranked = []
+        for probe in done:
+            if probe.exception() is None:
+                ranked.append((probe.result(), probes[probe]))
+            else:
+                LOG.debug('Skipping unreachable server %s', probes[probe])
+        return [host for latency, host in sorted(ranked)]
+
+    async def chooseserver(self):
+        ranked = await self.rankservers()
+        if not ranked:
+            raise Exception('Cannot find a test server')
+        LOG.debug('Best server: %s', ranked[0])
+        return ranked[0]
@@ -0,0 +1,188 @@
+#!./env/bin/python3
+
+"""Local stand-in for speedtest.net and its test servers, so that pyspeedtest and testinternet.py can be measured without
+the internet. It serves the endpoints pyspeedtest uses, with optional bandwidth shaping and added latency, and a made-up
+list of servers that all point back at itself.
+
+Run from the project directory:
+    python benchmarks/standin.py -p 8080 -r 100 -l 20     # 100 Mbit/s each way, 20 ms added to every response
+To use it, set pyspeedtest.SpeedTest.CONFIG_HOST to its address, or pass its address as the host of a SpeedTest.
+"""
+
+import argparse
+import os
+import random
+import re
+import sys
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+except ImportError:
+    sys.exit('standin.py needs Python 3.7 or later')
+
+# Bytes written or read at a time
+chunk_size = 64 * 1024
+
+randomreg = re.compile(r'^/speedtest/random(\d+)x\d+\.jpg')
+
+
+class TokenBucket(object):
+    """Limits the bytes per second going one way, shared by all connections"""
+
+    def __init__(self, bytes_per_second):
+        self.rate = float(bytes_per_second)
+        # Allow bursts of up to 50 ms at full rate
+        self.capacity = max(chunk_size, self.rate / 20)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, size):
+        """Waits until size bytes may be sent"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= size
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+def image_size(side):
+    """Roughly the size of speedtest.net's randomNxN.jpg"""
+    return side * side * 2
+
+
+def server_list(count, address, lat, lon, seed=1):
+    """speedtest-servers.php with count servers scattered around the world, all pointing at address. The nearest is about 50 km from lat/lon"""
+    rng = random.Random(seed)
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>', '<settings>', '<servers>']
+    for i in range(count):
+        if i == 0:
+            s_lat, s_lon = lat + 0.45, lon
+        else:
+            s_lat, s_lon = rng.uniform(-60, 70), rng.uniform(-180, 180)
+        lines.append('<server url="http://{address}/speedtest/upload.php" lat="{lat:.4f}" lon="{lon:.4f}" name="Stand-in {i}" country="Nowhere" cc="NW" sponsor="Benchmark" id="{i}" host="{address}" />'.format(address=address, lat=s_lat, lon=s_lon, i=i))
+    lines.extend(['</servers>', '</settings>', ''])
+    return '\n'.join(lines).encode('utf-8')
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Without TCP_NODELAY, small responses wait on the client's delayed ACK and pings come out ~40 ms too high
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def delay(self):
+        latency = self.server.latency
+        if latency:
+            time.sleep(max(0, latency + random.uniform(-self.server.jitter, self.server.jitter)))
+
+    def send_body(self, body, content_type='text/plain'):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.delay()
+        path = self.path.split('?')[0]
+        match = randomreg.match(path)
+        if match:
+            return self.send_random(image_size(int(match.group(1))))
+        if path == '/speedtest-config.php':
+            return self.send_body(self.server.config, 'text/xml')
+        if path in ('/speedtest-servers.php', '/speedtest-servers-static.php'):
+            return self.send_body(self.server.servers, 'text/xml')
+        if path == '/speedtest/latency.txt':
+            return self.send_body(b'test=test\n')
+        self.send_error(404)
+
+    def send_random(self, size):
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(size))
+        self.end_headers()
+        block = self.server.block
+        bucket = self.server.down
+        remaining = size
+        while remaining:
+            chunk = block[:min(remaining, chunk_size)]
+            if bucket is not None:
+                bucket.take(len(chunk))
+            self.wfile.write(chunk)
+            remaining -= len(chunk)
+
+    def do_POST(self):
+        self.delay()
+        if self.path.split('?')[0] != '/speedtest/upload.php':
+            self.send_error(404)
+            return
+        remaining = length = int(self.headers.get('Content-Length', 0))
+        bucket = self.server.up
+        while remaining:
+            if bucket is not None:
+                bucket.take(min(remaining, chunk_size))
+            data = self.rfile.read(min(remaining, chunk_size))
+            if not data:
+                break
+            remaining -= len(data)
+        self.send_body('size={}'.format(length - remaining).encode('ascii'))
+
+
+class StandIn(ThreadingHTTPServer):
+    daemon_threads = True
+    # Server selection opens hundreds of connections at once, which overflow the default backlog of 5 into SYN retries
+    request_queue_size = 256
+
+    def __init__(self, host='127.0.0.1', port=0, rate_mbit=None, up_mbit=None, latency_ms=0, jitter_ms=0, servers=5000, lat=40.0, lon=-75.0, verbose=False):
+        """rate_mbit limits downloads (and uploads unless up_mbit is given). latency_ms, give or take up to jitter_ms, is added before every response"""
+        ThreadingHTTPServer.__init__(self, (host, port), Handler)
+        self.address = '{}:{}'.format(*self.server_address[:2])
+        up_mbit = up_mbit or rate_mbit
+        self.down = TokenBucket(rate_mbit * 125000) if rate_mbit else None
+        self.up = TokenBucket(up_mbit * 125000) if up_mbit else None
+        self.latency = latency_ms / 1000.0
+        self.jitter = jitter_ms / 1000.0
+        self.verbose = verbose
+        self.block = memoryview(os.urandom(chunk_size))
+        self.config = '<?xml version="1.0" encoding="UTF-8"?>\n<settings>\n<client ip="127.0.0.1" lat="{lat}" lon="{lon}" isp="Stand-in" isprating="3.7" rating="0" ispdlavg="0" ispulavg="0" loggedin="0" country="NW" />\n</settings>\n'.format(lat=lat, lon=lon).encode('utf-8')
+        self.servers = server_list(servers, self.address, lat, lon)
+
+    def start(self):
+        """Serves on a background thread, returning the host:port to use"""
+        thread = threading.Thread(target=self.serve_forever, name='standin')
+        thread.daemon = True
+        thread.start()
+        return self.address
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serves a local stand-in for speedtest.net and its test servers')
+    parser.add_argument('-H', '--host', default='127.0.0.1', help='Address to listen on (default 127.0.0.1)')
+    parser.add_argument('-p', '--port', type=int, default=8080, help='Port to listen on (default 8080)')
+    parser.add_argument('-r', '--rate', type=float, help='Mbit/s to allow for downloads, and uploads unless -u/--uprate is given (default unlimited)')
+    parser.add_argument('-u', '--uprate', type=float, help='Mbit/s to allow for uploads')
+    parser.add_argument('-l', '--latency', type=float, default=0, help='Milliseconds to wait before every response (default 0)')
+    parser.add_argument('-j', '--jitter', type=float, default=0, help='Vary the latency by up to this many milliseconds either way (default 0)')
+    parser.add_argument('-n', '--servers', type=int, default=5000, help='Number of servers in speedtest-servers.php (default 5000)')
+    parser.add_argument('-v', '--verbose', help='Log every request', action="store_true")
+    args = parser.parse_args()
+
+    server = StandIn(args.host, args.port, args.rate, args.uprate, args.latency, args.jitter, args.servers, verbose=args.verbose)
+    print('Serving on {}'.format(server.address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
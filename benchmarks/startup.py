@@ -0,0 +1,103 @@
+#!./env/bin/python3
+
+"""Measures how long each subsystem of testinternet.py takes to import, each in a fresh interpreter, so that start-up regressions show up.
+
+Run from the project directory:
+    python benchmarks/startup.py -o startup.jsonl            # record a run
+    python benchmarks/startup.py -b startup.jsonl -t 1.5     # fail if anything got 1.5x slower than the last recorded run
+"""
+
+import argparse
+import datetime
+import json
+import os
+import subprocess
+import sys
+
+project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# (name, import statement)
+subsystems = [
+    ('pyspeedtest', 'import pyspeedtest'),
+    ('fastdb', 'import fastdb'),
+    ('scheduler', 'import scheduler'),
+    ('orm', 'import models'),
+    ('export', 'import export'),
+    ('scp', 'import paramiko, scp'),
+    ('testinternet', 'import testinternet'),
+]
+
+timer = 'import time; start = time.perf_counter(); {statement}; print(time.perf_counter() - start)'
+
+# Changes smaller than this many ms are noise
+min_regression_ms = 5
+
+
+def time_import(statement, repeats):
+    """Returns the fastest of repeats imports of statement, in ms"""
+    times = []
+    for _ in range(repeats):
+        out = subprocess.run([sys.executable, '-W', 'ignore', '-c', timer.format(statement=statement)], cwd=project_dir, stdout=subprocess.PIPE, check=True)
+        times.append(float(out.stdout) * 1000)
+    return min(times)
+
+
+def time_startup(args, repeats):
+    """Returns the fastest of repeats complete runs of python with args, in ms"""
+    times = []
+    for _ in range(repeats):
+        start = datetime.datetime.now()
+        subprocess.run([sys.executable, '-W', 'ignore'] + args, cwd=project_dir, stdout=subprocess.DEVNULL, check=True)
+        times.append((datetime.datetime.now() - start).total_seconds() * 1000)
+    return min(times)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=project_dir, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode().strip()
+    except OSError:
+        return ''
+
+
+def run(repeats):
+    results = {}
+    results['interpreter'] = round(time_startup(['-c', 'pass'], repeats), 2)
+    for name, statement in subsystems:
+        results[name] = round(time_import(statement, repeats), 2)
+    results['testinternet -h'] = round(time_startup(['testinternet.py', '-h'], repeats), 2)
+    return results
+
+
+def regressions(results, baseline, tolerance):
+    slower = []
+    for name, ms in results.items():
+        before = baseline.get(name)
+        if before and ms > before * tolerance and ms - before > min_regression_ms:
+            slower.append((name, before, ms))
+    return slower
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Times the start-up of testinternet.py and the import of each of its subsystems')
+    parser.add_argument('-r', '--repeats', type=int, default=5, help='Runs per measurement, the fastest is kept (default 5)')
+    parser.add_argument('-o', '--output', help='Append the results to this JSON lines file')
+    parser.add_argument('-b', '--baseline', help='JSON lines file to compare against (its last line)')
+    parser.add_argument('-t', '--tolerance', type=float, default=1.5, help='Fail if a measurement is this many times slower than the baseline (default 1.5)')
+    args = parser.parse_args()
+
+    results = run(args.repeats)
+    for name, ms in results.items():
+        print('{name:<16} {ms:>9.2f} ms'.format(name=name, ms=ms))
+
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write(json.dumps({'date': datetime.datetime.utcnow().isoformat(), 'commit': git_commit(), 'python': sys.version.split()[0], 'ms': results}) + '\n')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.loads(f.readlines()[-1])['ms']
+        slower = regressions(results, baseline, args.tolerance)
+        for name, before, ms in slower:
+            print('REGRESSION {name}: {before:.2f} ms -> {ms:.2f} ms'.format(name=name, before=before, ms=ms))
+        if slower:
+            sys.exit(1)
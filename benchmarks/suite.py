@@ -0,0 +1,237 @@
+#!./env/bin/python3
+
+"""Measures pyspeedtest and testinternet.py against the local stand-in server (benchmarks/standin.py), so that
+performance changes can be checked without the internet and compared across versions:
+
+    transfer     client CPU per Mbit and Mbit/s for downloads and uploads over an unlimited link
+    selection    time to choose a server from a list of thousands (threads and asyncio)
+    iteration    time per testinternet.py test iteration over a shaped link
+    db           results stored, exported and rolled up per second
+
+Run from the project directory:
+    python benchmarks/suite.py -o suite.jsonl            # record a run
+    python benchmarks/suite.py -b suite.jsonl -t 1.5     # fail if anything got 1.5x worse than the last recorded run
+"""
+
+import argparse
+import datetime
+import io
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, project_dir)
+
+import pyspeedtest
+
+# Names ending in these are better when higher, everything else (times, CPU) when lower
+higher_is_better = ('_per_s', '_mbit_s')
+
+# Changes smaller than this fraction of the baseline are noise
+min_regression = 0.05
+
+# Results stored for the db benchmarks
+db_rows = 20000
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class StandInProcess(object):
+    """benchmarks/standin.py in its own process, so that its CPU time isn't counted as the client's"""
+
+    def __init__(self, *args):
+        self.address = '127.0.0.1:{}'.format(free_port())
+        self.args = ['-p', self.address.split(':')[1]] + [str(a) for a in args]
+
+    def __enter__(self):
+        self.process = subprocess.Popen([sys.executable, os.path.join(project_dir, 'benchmarks', 'standin.py')] + self.args, stdout=subprocess.DEVNULL)
+        deadline = time.time() + 10
+        while True:
+            try:
+                socket.create_connection(tuple(self.address.split(':')), 1).close()
+                return self
+            except OSError:
+                if time.time() > deadline:
+                    self.process.kill()
+                    raise Exception('Stand-in server did not start')
+                time.sleep(0.05)
+
+    def __exit__(self, *exc):
+        self.process.terminate()
+        self.process.wait()
+
+
+def transferred_bytes(st, kind, bps, seconds):
+    samples = st.samples.get(kind)
+    if samples:
+        return samples[-1][1]
+    return bps * seconds / 8
+
+
+def bench_transfer(results):
+    with StandInProcess('-n', 10) as server:
+        for kind in ('download', 'upload'):
+            st = pyspeedtest.SpeedTest(server.address, runs=4, pool=pyspeedtest.ConnectionPool())
+            getattr(st, kind)()  # warm up connections and payloads
+            cpu = time.process_time()
+            start = time.perf_counter()
+            bps = getattr(st, kind)()
+            seconds = time.perf_counter() - start
+            cpu = time.process_time() - cpu
+            mbit = transferred_bytes(st, kind, bps, seconds) * 8 / 1e6
+            st.pool.close()
+            results[kind + '_cpu_ms_per_mbit'] = cpu * 1000 / mbit
+            results[kind + '_mbit_s'] = bps / 1e6
+
+
+def bench_selection(results):
+    with StandInProcess('-n', 5000) as server:
+        saved = pyspeedtest.SpeedTest.CONFIG_HOST
+        pyspeedtest.SpeedTest.CONFIG_HOST = server.address
+        try:
+            for engine in ('thread', 'asyncio'):
+                start = time.perf_counter()
+                pyspeedtest.SpeedTest(engine=engine).chooseserver()
+                results['selection_{}_ms'.format(engine)] = (time.perf_counter() - start) * 1000
+        finally:
+            pyspeedtest.SpeedTest.CONFIG_HOST = saved
+
+
+def bench_iteration(results, workdir, iterations=3):
+    import models
+    import testinternet
+    with StandInProcess('-n', 100, '-r', 200, '-l', 10) as server:
+        saved = pyspeedtest.SpeedTest.CONFIG_HOST
+        pyspeedtest.SpeedTest.CONFIG_HOST = server.address
+        try:
+            sess = models.init_db('sqlite:///' + os.path.join(workdir, 'iteration.sqlite'))
+            choice = testinternet.choose_server(sess)
+            pool = pyspeedtest.ConnectionPool()
+            testinternet.times_to_take_test = iterations
+            start = time.perf_counter()
+            testinternet.run_tests(sess, choice, pool)
+            results['iteration_ms'] = (time.perf_counter() - start) * 1000 / iterations
+            pool.close()
+            sess.close()
+        finally:
+            pyspeedtest.SpeedTest.CONFIG_HOST = saved
+
+
+def bench_db(results, workdir):
+    import export
+    import fastdb
+    import models
+    import rollups
+    sess = models.init_db('sqlite:///' + os.path.join(workdir, 'db.sqlite'))
+    now = time.time() - db_rows * 60
+    start = time.perf_counter()
+    for i in range(db_rows):
+        sess.add(models.TestResult(date=now + i * 60, ping=20 + i % 7, download=50 + i % 13, upload=5 + i % 3))
+    sess.commit()
+    results['orm_insert_per_s'] = db_rows / (time.perf_counter() - start)
+
+    fast = fastdb.FastSession(os.path.join(workdir, 'db.sqlite'))
+    start = time.perf_counter()
+    for i in range(db_rows):
+        fast.add(fastdb.Result(date=now + i * 60, ping=20, download=50, upload=5))
+    fast.commit()
+    results['fast_insert_per_s'] = db_rows / (time.perf_counter() - start)
+    fast.close()
+
+    for fmt in ('csv', 'csv.gz', 'col'):
+        start = time.perf_counter()
+        export.write_export(models.iter_rows(sess), io.BytesIO(), fmt, 'bench', False)
+        results['export_{}_per_s'.format(fmt.replace('.', '_'))] = db_rows * 2 / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    rollups.update_rollups(sess)
+    results['rollup_per_s'] = db_rows * 2 / (time.perf_counter() - start)
+    sess.close()
+
+
+benchmarks = ['transfer', 'selection', 'iteration', 'db']
+
+
+def run(names, repeats):
+    """Returns the best result of repeats runs of each benchmark"""
+    best = {}
+    for _ in range(repeats):
+        workdir = tempfile.mkdtemp()
+        try:
+            results = {}
+            if 'transfer' in names:
+                bench_transfer(results)
+            if 'selection' in names:
+                bench_selection(results)
+            if 'iteration' in names:
+                bench_iteration(results, workdir)
+            if 'db' in names:
+                bench_db(results, workdir)
+        finally:
+            shutil.rmtree(workdir)
+        for name, value in results.items():
+            better = max if name.endswith(higher_is_better) else min
+            best[name] = round(better(best.get(name, value), value), 3)
+    return best
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=project_dir, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode().strip()
+    except OSError:
+        return ''
+
+
+def regressions(results, baseline, tolerance):
+    worse = []
+    for name, value in results.items():
+        before = baseline.get(name)
+        if not before:
+            continue
+        if name.endswith(higher_is_better):
+            regressed = value * tolerance < before
+        else:
+            regressed = value > before * tolerance
+        if regressed and abs(value - before) > before * min_regression:
+            worse.append((name, before, value))
+    return worse
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmarks pyspeedtest and testinternet.py against a local stand-in server')
+    parser.add_argument('-r', '--repeats', type=int, default=3, help='Runs of each benchmark, the best is kept (default 3)')
+    parser.add_argument('-k', '--only', choices=benchmarks, action='append', help='Run just this benchmark. Can be given more than once')
+    parser.add_argument('-o', '--output', help='Append the results to this JSON lines file')
+    parser.add_argument('-b', '--baseline', help='JSON lines file to compare against (its last line)')
+    parser.add_argument('-t', '--tolerance', type=float, default=1.5, help='Fail if a measurement is this many times worse than the baseline (default 1.5)')
+    args = parser.parse_args()
+
+    os.chdir(project_dir)
+    results = run(args.only or benchmarks, args.repeats)
+    for name, value in sorted(results.items()):
+        print('{name:<28} {value:>12.3f}'.format(name=name, value=value))
+
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write(json.dumps({'date': datetime.datetime.utcnow().isoformat(), 'commit': git_commit(), 'python': sys.version.split()[0], 'results': results}) + '\n')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.loads(f.readlines()[-1])['results']
+        worse = regressions(results, baseline, args.tolerance)
+        for name, before, value in worse:
+            print('REGRESSION {name}: {before:.3f} -> {value:.3f}'.format(name=name, before=before, value=value))
+        if worse:
+            sys.exit(1)
@@ -0,0 +1,413 @@
+"""Writes test results to file-like sinks a row at a time, so that exporting a backlog of weeks takes no more memory than exporting a day"""
+
+import base64
+import csv
+import datetime
+import gzip
+import io
+import smtplib
+import struct
+import tempfile
+import sys
+import uuid
+from array import array
+from email.header import Header
+from email.utils import encode_rfc2231
+
+# Exports are kept in memory up to this size, and spill to a temporary file beyond it
+spool_bytes = 1024 * 1024
+
+csv_header = "pk,date,devicename,upload,download,ping,target\n"
+csv_row = ",{date},{devicename},{upload},{download},{ping},{target}\n"
+
+# Export formats are csv or col (columnar), optionally compressed: csv.gz, csv.zst, col.gz, col.zst. zst needs the zstandard package
+formats = ('csv', 'csv.gz', 'csv.zst', 'col', 'col.gz', 'col.zst')
+
+content_types = {
+    'csv': 'text/csv; charset="utf-8"',
+    'col': 'application/octet-stream',
+    'gz': 'application/gzip',
+    'zst': 'application/zstd',
+}
+
+# Columnar exports start with the magic, the device name and the (name, array typecode) of each column, followed by
+# blocks of up to columnar_block rows: a row count, then each column as a little-endian array. A block of 0 rows ends the file.
+# Missing speeds (ping-only results) are NaN. String columns (typecode s) are a uint32 array of the UTF-8 lengths followed
+# by the strings, with length 0 for none (results of the chosen server have no target)
+columnar_magic = b'RITCOL2\n'
+columnar_magics = (b'RITCOL1\n', columnar_magic)
+columnar_columns = (('id', 'q'), ('date', 'd'), ('ping', 'd'), ('upload', 'd'), ('download', 'd'), ('target', 's'))
+columnar_block = 4096
+
+
+def date_formatter(useutc):
+    """Returns a function that formats a timestamp the way the reports always have"""
+    if useutc:
+        utcfromtimestamp = datetime.datetime.utcfromtimestamp
+        return lambda timestamp: str(utcfromtimestamp(timestamp))
+    fromtimestamp = datetime.datetime.fromtimestamp
+    return lambda timestamp: fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S %z')
+
+
+def write_rows(rows, sink, header, template, devicename, useutc, on_row=None):
+    """Writes header, then template filled in for each row. on_row, if given, is called with each row once it is written"""
+    fmt = template.format
+    date = date_formatter(useutc)
+    write = sink.write
+    write(header)
+    for rec in rows:
+        write(fmt(date=date(rec.date), devicename=devicename, upload=rec.upload, download=rec.download, ping=rec.ping, target=rec.target or ''))
+        if on_row is not None:
+            on_row(rec)
+
+
+def write_csv(rows, sink, devicename, useutc, on_row=None, header=True):
+    write_rows(rows, sink, csv_header if header else '', csv_row, devicename, useutc, on_row)
+
+
+def write_columnar(rows, sink, devicename, on_row=None):
+    """Writes rows to a binary sink in the columnar format, a block at a time"""
+    nan = float('nan')
+    name = devicename.encode('utf-8')
+    header = [columnar_magic, struct.pack('<HB', len(name), len(columnar_columns)), name]
+    for column, typecode in columnar_columns:
+        header.append(struct.pack('<B', len(column)) + column.encode('ascii') + typecode.encode('ascii'))
+    sink.write(b''.join(header))
+    block = new_columnar_block()
+    ids, dates, pings, uploads, downloads, targets = block
+    for rec in rows:
+        ids.append(rec.id)
+        dates.append(rec.date)
+        pings.append(nan if rec.ping is None else rec.ping)
+        uploads.append(nan if rec.upload is None else rec.upload)
+        downloads.append(nan if rec.download is None else rec.download)
+        targets.append(rec.target)
+        if on_row is not None:
+            on_row(rec)
+        if len(ids) == columnar_block:
+            write_columnar_block(sink, block)
+            block = new_columnar_block()
+            ids, dates, pings, uploads, downloads, targets = block
+    if len(ids):
+        write_columnar_block(sink, block)
+    sink.write(struct.pack('<I', 0))
+
+
+def new_columnar_block():
+    return [[] if typecode == 's' else array(typecode) for _, typecode in columnar_columns]
+
+
+def write_columnar_block(sink, block):
+    sink.write(struct.pack('<I', len(block[0])))
+    for column in block:
+        if isinstance(column, list):
+            write_string_column(sink, column)
+            continue
+        if sys.byteorder != 'little':
+            column.byteswap()
+        sink.write(column.tobytes())
+
+
+def write_string_column(sink, strings):
+    encoded = [b'' if string is None else string.encode('utf-8') for string in strings]
+    lengths = array('I', [len(data) for data in encoded])
+    if sys.byteorder != 'little':
+        lengths.byteswap()
+    sink.write(lengths.tobytes())
+    sink.write(b''.join(encoded))
+
+
+def read_string_column(source, count):
+    lengths = array('I')
+    lengths.frombytes(read_exactly(source, count * lengths.itemsize))
+    if sys.byteorder != 'little':
+        lengths.byteswap()
+    data = read_exactly(source, sum(lengths))
+    strings = []
+    offset = 0
+    for length in lengths:
+        strings.append(data[offset:offset + length].decode('utf-8') if length else None)
+        offset += length
+    return strings
+
+
+def read_exactly(source, size):
+    data = source.read(size)
+    while len(data) < size:
+        more = source.read(size - len(data))
+        if not more:
+            raise ValueError('Columnar export ends early')
+        data += more
+    return data
+
+
+def read_columnar(source):
+    """Reads a columnar export from a binary file, returning (devicename, {column name: array, or list for string
+    columns}) with all blocks joined"""
+    if read_exactly(source, len(columnar_magic)) not in columnar_magics:
+        raise ValueError('Not a columnar export')
+    name_length, column_count = struct.unpack('<HB', read_exactly(source, 3))
+    devicename = read_exactly(source, name_length).decode('utf-8')
+    columns = []
+    for _ in range(column_count):
+        length = read_exactly(source, 1)[0]
+        spec = read_exactly(source, length + 1).decode('ascii')
+        columns.append((spec[:-1], [] if spec[-1] == 's' else array(spec[-1])))
+    while True:
+        count = struct.unpack('<I', read_exactly(source, 4))[0]
+        if not count:
+            break
+        for _, values in columns:
+            if isinstance(values, list):
+                values.extend(read_string_column(source, count))
+                continue
+            block = array(values.typecode)
+            block.frombytes(read_exactly(source, count * block.itemsize))
+            if sys.byteorder != 'little':
+                block.byteswap()
+            values.extend(block)
+    return devicename, dict(columns)
+
+
+def read_csv(source):
+    """Reads a CSV export from a binary file, yielding a dict per row with the speeds as floats (None for ping-only results)
+    and the target (None for the chosen server)"""
+    text = io.TextIOWrapper(source, encoding='utf-8', newline='')
+    try:
+        for row in csv.DictReader(text):
+            for column in ('upload', 'download', 'ping'):
+                row[column] = None if row[column] in ('', 'None') else float(row[column])
+            if 'target' not in row:
+                # Rows appended over SFTP to a daily file started before targets were exported
+                row['target'] = (row.pop(None, None) or [None])[0]
+            row['target'] = row['target'] or None
+            yield row
+    finally:
+        text.detach()
+
+
+def split_format(fmt):
+    base, _, compression = fmt.partition('.')
+    if fmt not in formats:
+        raise ValueError('Unknown export format {}, use one of {}'.format(fmt, ', '.join(formats)))
+    return base, compression
+
+
+def content_type(fmt):
+    base, compression = split_format(fmt)
+    return content_types[compression or base]
+
+
+def zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise Exception('zst export formats need the zstandard package (pip install zstandard)')
+    return zstandard
+
+
+def compressing(sink, compression):
+    """Binary writer that compresses onto sink. Closing it finishes the compressed stream but leaves sink open"""
+    if compression == 'gz':
+        return gzip.GzipFile(fileobj=sink, mode='wb')
+    if compression == 'zst':
+        return zstandard().ZstdCompressor().stream_writer(sink, closefd=False)
+    return None
+
+
+def decompressing(source, compression):
+    if compression == 'gz':
+        return gzip.GzipFile(fileobj=source, mode='rb')
+    if compression == 'zst':
+        return zstandard().ZstdDecompressor().stream_reader(source)
+    return source
+
+
+def write_export(rows, sink, fmt, devicename, useutc, on_row=None, header=True):
+    """Writes rows to a binary sink in one of the formats. header=False leaves out the CSV header line, for appending to an existing file"""
+    base, compression = split_format(fmt)
+    out = compressing(sink, compression) or sink
+    if base == 'csv':
+        text = text_sink(out)
+        write_csv(rows, text, devicename, useutc, on_row, header)
+        text.detach()
+    else:
+        write_columnar(rows, out, devicename, on_row)
+    if out is not sink:
+        out.close()
+
+
+def read_export(source, fmt):
+    """Reads an export in any of the formats from a binary file, yielding a dict per row. Dates are timestamps for
+    columnar exports, and the formatted strings for CSV"""
+    base, compression = split_format(fmt)
+    source = decompressing(source, compression)
+    if base == 'csv':
+        for row in read_csv(source):
+            yield row
+        return
+    nan_to_none = lambda value: None if value != value else value
+    devicename, columns = read_columnar(source)
+    targets = columns.get('target') or [None] * len(columns['id'])
+    for i in range(len(columns['id'])):
+        yield {
+            'id': columns['id'][i],
+            'date': columns['date'][i],
+            'devicename': devicename,
+            'upload': nan_to_none(columns['upload'][i]),
+            'download': nan_to_none(columns['download'][i]),
+            'ping': nan_to_none(columns['ping'][i]),
+            'target': targets[i],
+        }
+
+
+rollup_header = """\
+| {period} | Tests | Ping (ms) mean / p95 | Download (mbps) mean / p50 / p95 | Upload (mbps) mean / p50 / p95 |
+| ---- | ----- | -------------------- | -------------------------------- | ------------------------------ |
+"""
+rollup_row = "| {start} | {count} | {ping_mean} / {ping_p95} | {download_mean} / {download_p50} / {download_p95} | {upload_mean} / {upload_p50} / {upload_p95} |\n"
+
+
+def write_rollup_table(rollups, sink, period, useutc):
+    """Writes hourly or daily rollups (models.Rollup) as a table like the email one"""
+    fromtimestamp = datetime.datetime.utcfromtimestamp if useutc else datetime.datetime.fromtimestamp
+    start_format = '%Y-%m-%d %H:00' if period == 'hour' else '%Y-%m-%d'
+    sink.write(rollup_header.format(period=period.capitalize()))
+    for rollup in rollups:
+        stats = {}
+        for metric in ('ping', 'download', 'upload'):
+            for stat in ('mean', 'p50', 'p95'):
+                value = getattr(rollup, '{}_{}'.format(metric, stat))
+                stats['{}_{}'.format(metric, stat)] = '-' if value is None else round(value, 2)
+        sink.write(rollup_row.format(start=fromtimestamp(rollup.start).strftime(start_format), count=rollup.count, **stats))
+
+
+def target_cell(ping, download, upload):
+    return ' / '.join('-' if value is None else str(round(value, 2)) for value in (ping, download, upload))
+
+
+def write_target_table(rollups, sink, period, useutc):
+    """Writes the rollups of several targets side by side, a column per target with the mean ping / download / upload of
+    each period, and a last row with the means over all the periods"""
+    fromtimestamp = datetime.datetime.utcfromtimestamp if useutc else datetime.datetime.fromtimestamp
+    start_format = '%Y-%m-%d %H:00' if period == 'hour' else '%Y-%m-%d'
+    targets = sorted(set(rollup.target for rollup in rollups), key=lambda target: (target is not None, target))
+    names = [target or 'chosen server' for target in targets]
+    sink.write('| {} | {} |\n'.format(period.capitalize(), ' | '.join('{} ping / down / up'.format(name) for name in names)))
+    sink.write('| {} | {} |\n'.format('-' * len(period), ' | '.join('-' * (len(name) + 19) for name in names)))
+    by_start = {}
+    totals = dict((target, dict((metric, [0, 0.0]) for metric in ('ping', 'download', 'upload'))) for target in targets)
+    for rollup in rollups:
+        by_start.setdefault(rollup.start, {})[rollup.target] = rollup
+        for metric, total in totals[rollup.target].items():
+            count, mean = getattr(rollup, metric + '_count'), getattr(rollup, metric + '_mean')
+            if count and mean is not None:
+                total[0] += count
+                total[1] += count * mean
+    for start in sorted(by_start):
+        cells = []
+        for target in targets:
+            rollup = by_start[start].get(target)
+            cells.append(target_cell(*(getattr(rollup, metric + '_mean') if rollup is not None else None for metric in ('ping', 'download', 'upload'))))
+        sink.write('| {} | {} |\n'.format(fromtimestamp(start).strftime(start_format), ' | '.join(cells)))
+    cells = []
+    for target in targets:
+        cells.append(target_cell(*(total[1] / total[0] if total[0] else None for total in (totals[target][metric] for metric in ('ping', 'download', 'upload')))))
+    sink.write('| All | {} |\n'.format(' | '.join(cells)))
+
+
+def spool():
+    """Binary file that stays in memory while it is small"""
+    return tempfile.SpooledTemporaryFile(max_size=spool_bytes, mode='w+b')
+
+
+def text_sink(binary):
+    """Text writer over a binary file. Call detach() on it when done, to keep the binary file open"""
+    return io.TextIOWrapper(binary, encoding='utf-8', newline='')
+
+
+class Base64Lines(io.RawIOBase):
+    """Binary writer that base64 encodes what is written into 76 character CRLF lines on another binary file"""
+
+    def __init__(self, sink):
+        self.sink = sink
+        self.pending = b''
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        pending = self.pending + data
+        whole = len(pending) - len(pending) % 57
+        for start in range(0, whole, 57):
+            self.sink.write(base64.b64encode(pending[start:start + 57]) + b'\r\n')
+        self.pending = pending[whole:]
+        return len(data)
+
+    def close(self):
+        if self.pending:
+            self.sink.write(base64.b64encode(self.pending) + b'\r\n')
+            self.pending = b''
+        super(Base64Lines, self).close()
+
+
+def header_value(value):
+    try:
+        value.encode('ascii')
+        return value
+    except UnicodeEncodeError:
+        return Header(value, 'utf-8').encode()
+
+
+def filename_param(filename):
+    try:
+        filename.encode('ascii')
+        return 'filename="{}"'.format(filename)
+    except UnicodeEncodeError:
+        return "filename*={}".format(encode_rfc2231(filename, 'utf-8'))
+
+
+def write_email(sink, sender, recipient, subject, body, attachments):
+    """Writes a multipart email to a binary sink. attachments is a list of (filename, content type, write) where write(binary sink) writes the attachment"""
+    boundary = '=={}=='.format(uuid.uuid4().hex)
+    headers = [
+        'Content-Type: multipart/mixed; boundary="{}"'.format(boundary),
+        'MIME-Version: 1.0',
+        'Subject: {}'.format(header_value(subject)),
+        'From: {}'.format(sender),
+        'To: {}'.format(recipient),
+    ]
+    sink.write(('\r\n'.join(headers) + '\r\n\r\n').encode('utf-8'))
+    for filename, content_type, write in attachments:
+        sink.write('--{boundary}\r\nContent-Type: {content_type}\r\nMIME-Version: 1.0\r\nContent-Transfer-Encoding: base64\r\nContent-Disposition: attachment; {filename}\r\n\r\n'.format(boundary=boundary, content_type=content_type, filename=filename_param(filename)).encode('utf-8'))
+        encoder = Base64Lines(sink)
+        write(encoder)
+        encoder.close()
+    sink.write('--{boundary}\r\nContent-Type: text/plain; charset="utf-8"\r\nMIME-Version: 1.0\r\nContent-Transfer-Encoding: base64\r\n\r\n'.format(boundary=boundary).encode('utf-8'))
+    encoder = Base64Lines(sink)
+    encoder.write(body.encode('utf-8'))
+    encoder.close()
+    sink.write('--{boundary}--\r\n'.format(boundary=boundary).encode('utf-8'))
+
+
+def smtp_send_file(server, sender, recipient, message):
+    """Like SMTP.sendmail(), but sends the message a line at a time from a binary file of CRLF lines"""
+    server.ehlo_or_helo_if_needed()
+    code, resp = server.mail(sender)
+    if code != 250:
+        raise smtplib.SMTPSenderRefused(code, resp, sender)
+    code, resp = server.rcpt(recipient)
+    if code not in (250, 251):
+        raise smtplib.SMTPRecipientsRefused({recipient: (code, resp)})
+    code, resp = server.docmd('data')
+    if code != 354:
+        raise smtplib.SMTPDataError(code, resp)
+    for line in message:
+        if line.startswith(b'.'):
+            line = b'.' + line
+        server.send(line)
+    server.send(b'.\r\n')
+    code, resp = server.getreply()
+    if code != 250:
+        raise smtplib.SMTPDataError(code, resp)
@@ -0,0 +1,89 @@
+"""Stores test results with the sqlite3 module alone, so that short runs (testinternet.py -f) don't pay for loading SQLAlchemy. The tables must already exist, which any normal run takes care of"""
+
+import sqlite3
+
+
+class Result(object):
+    """Stand-in for models.TestResult, with the same defaults"""
+
+    def __init__(self, **kwargs):
+        self.ping = 0
+        self.upload = 0
+        self.download = 0
+        self.sent = False
+        self.phases = []
+        self.__dict__.update(kwargs)
+
+    def set_ping_only(self):
+        self.download = None
+        self.upload = None
+
+    def set_ping_lost(self):
+        self.ping = None
+
+    def add_phase(self, **kwargs):
+        self.phases.append(kwargs)
+
+    def __repr__(self):
+        return '{{"date":{date},"ping":{ping},"upload":{upload},"download":{download}}}'.format(date=self.date, ping=self.ping, upload=self.upload, download=self.download)
+
+
+class Choice(object):
+    """Stand-in for models.ServerChoice"""
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+    def candidate_list(self):
+        return [c for c in (self.candidates or '').split(',') if c]
+
+
+class FastSession(object):
+    """Just enough of a SQLAlchemy session (add/commit/close) for recording results"""
+
+    def __init__(self, path='db.sqlite'):
+        self.conn = sqlite3.connect(path)
+        # journal_mode=WAL is already stored in the database by models.init_db()
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('PRAGMA busy_timeout=5000')
+        self.pending = []
+        self.columns = {}
+        for table in ('testresults', 'phasetimings', 'serverchoice'):
+            self.columns[table] = [row[1] for row in self.conn.execute('PRAGMA table_info({})'.format(table))]
+        if not self.columns['testresults']:
+            self.conn.close()
+            raise Exception('{} has no testresults table yet'.format(path))
+
+    def add(self, record):
+        if record is not None:
+            self.pending.append(record)
+
+    def insert(self, table, values):
+        values = dict((k, v) for k, v in values.items() if k in self.columns[table] and k != 'id')
+        cursor = self.conn.execute('INSERT INTO {table} ({columns}) VALUES ({marks})'.format(table=table, columns=', '.join(values), marks=', '.join('?' * len(values))), list(values.values()))
+        return cursor.lastrowid
+
+    def commit(self):
+        with self.conn:
+            for record in self.pending:
+                record.id = self.insert('testresults', vars(record))
+                for phase in record.phases:
+                    self.insert('phasetimings', dict(phase, testresult_id=record.id))
+        self.pending = []
+
+    def cached_choice(self):
+        """The stored server choice, or None"""
+        if not self.columns['serverchoice']:
+            return None
+        row = self.conn.execute('SELECT {} FROM serverchoice ORDER BY date DESC LIMIT 1'.format(', '.join(self.columns['serverchoice']))).fetchone()
+        if row is None:
+            return None
+        return Choice(**dict(zip(self.columns['serverchoice'], row)))
+
+    def save_choice(self, choice):
+        """Stores changes to the host, candidates and date of a choice from cached_choice()"""
+        with self.conn:
+            self.conn.execute('UPDATE serverchoice SET host = ?, candidates = ?, date = ? WHERE id = ?', (choice.host, choice.candidates, choice.date, choice.id))
+
+    def close(self):
+        self.conn.close()
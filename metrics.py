@@ -0,0 +1,186 @@
+"""Live metrics for testinternet.py in the Prometheus text format, so that monitoring sees results as they are recorded
+instead of when the next batch is delivered. Everything is kept in memory and updated as tests run, so a scrape never
+touches the database"""
+
+import collections
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+metrics = ('ping', 'download', 'upload')
+units = {'ping': 'ms', 'download': 'mbps', 'upload': 'mbps'}
+
+# Upper bounds of the histogram buckets
+ping_buckets = (5, 10, 20, 30, 50, 75, 100, 150, 200, 300, 500, 1000)
+duration_buckets = (1, 2, 5, 10, 20, 30, 60, 120, 300)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in labels) + '}'
+
+
+def target_label(target):
+    """No label for the chosen server, so single-target runs look the same as before"""
+    return () if target is None else (('target', target),)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name, labels=()):
+        labels = tuple(labels)
+        for bound, count in zip(self.buckets, self.counts):
+            yield '{}_bucket{} {}'.format(name, format_labels(labels + (('le', format_value(bound)),)), count)
+        yield '{}_bucket{} {}'.format(name, format_labels(labels + (('le', '+Inf'),)), self.count)
+        yield '{}_sum{} {}'.format(name, format_labels(labels), format_value(self.sum))
+        yield '{}_count{} {}'.format(name, format_labels(labels), self.count)
+
+
+class Metrics(object):
+    """The latest result, the mean of the last window results, histograms of ping and test duration, test and failure
+    counts, and the number of results waiting for delivery. Results of a multi-target run are labelled with their target"""
+
+    def __init__(self, devicename, window=20):
+        self.devicename = devicename
+        self.window = window
+        self.lock = threading.Lock()
+        self.latest = {} # target: {metric: value}
+        self.recent = {} # target: {metric: deque of values}
+        self.ping_histograms = {} # target: Histogram
+        self.durations = {} # kind: Histogram
+        self.tests = collections.Counter() # kind: count
+        self.failures = collections.Counter() # stage: count
+        self.last_test = None
+        self.backlog = None
+        self.server = None
+
+    def record(self, record, kind, duration, failed_stage=None):
+        """Adds a finished test and its TestResult (or fastdb.Result), if one was stored. kind is 'speed' or 'ping'. The
+        results of failed tests count towards the backlog but not the gauges"""
+        with self.lock:
+            self.tests[kind] += 1
+            self.durations.setdefault(kind, Histogram(duration_buckets)).observe(duration)
+            if failed_stage:
+                self.failures[failed_stage] += 1
+            if record is None:
+                return
+            if self.backlog is not None:
+                self.backlog += 1
+            if failed_stage:
+                return
+            self.last_test = record.date
+            target = getattr(record, 'target', None)
+            latest = self.latest.setdefault(target, {})
+            recent = self.recent.setdefault(target, dict((metric, collections.deque(maxlen=self.window)) for metric in metrics))
+            for metric in metrics:
+                value = getattr(record, metric, None)
+                # Ping-only TestResults hold SQLAlchemy's null() for the speeds until they are flushed
+                if not isinstance(value, (int, float)) or (metric == 'ping' and not value):
+                    continue
+                latest[metric] = value
+                recent[metric].append(value)
+                if metric == 'ping':
+                    self.ping_histograms.setdefault(target, Histogram(ping_buckets)).observe(value)
+
+    def set_backlog(self, count):
+        with self.lock:
+            self.backlog = count
+
+    def set_server(self, host):
+        with self.lock:
+            self.server = host
+
+    def render(self):
+        """The metrics in the Prometheus text exposition format"""
+        lines = []
+
+        def family(name, kind, help):
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, kind))
+
+        with self.lock:
+            family('testinternet_info', 'gauge', 'Device name and current speedtest server')
+            lines.append('testinternet_info{} 1'.format(format_labels((('device', self.devicename), ('server', self.server or '')))))
+            targets = sorted(self.latest, key=lambda target: (target is not None, target))
+            for metric in metrics:
+                name = 'testinternet_{}_{}'.format(metric, units[metric])
+                family(name, 'gauge', 'Latest {} result'.format(metric))
+                for target in targets:
+                    if metric in self.latest[target]:
+                        lines.append('{}{} {}'.format(name, format_labels(target_label(target)), format_value(self.latest[target][metric])))
+                family(name + '_mean', 'gauge', 'Mean {} of the last results'.format(metric))
+                for target in targets:
+                    recent = self.recent[target][metric]
+                    if recent:
+                        lines.append('{}{} {}'.format(name + '_mean', format_labels(target_label(target) + (('window', self.window),)), format_value(sum(recent) / len(recent))))
+            family('testinternet_ping_latency_ms', 'histogram', 'Ping of every result')
+            for target in sorted(self.ping_histograms, key=lambda target: (target is not None, target)):
+                lines.extend(self.ping_histograms[target].lines('testinternet_ping_latency_ms', target_label(target)))
+            family('testinternet_test_duration_seconds', 'histogram', 'Time taken by each speed or ping test')
+            for kind in sorted(self.durations):
+                lines.extend(self.durations[kind].lines('testinternet_test_duration_seconds', (('kind', kind),)))
+            family('testinternet_tests_total', 'counter', 'Tests run')
+            for kind in sorted(self.tests):
+                lines.append('testinternet_tests_total{} {}'.format(format_labels((('kind', kind),)), self.tests[kind]))
+            family('testinternet_test_failures_total', 'counter', 'Tests that failed, by the stage that failed')
+            for stage in sorted(self.failures):
+                lines.append('testinternet_test_failures_total{} {}'.format(format_labels((('stage', stage),)), self.failures[stage]))
+            if self.last_test is not None:
+                family('testinternet_last_test_timestamp_seconds', 'gauge', 'When the latest result was recorded')
+                lines.append('testinternet_last_test_timestamp_seconds {}'.format(format_value(self.last_test)))
+            if self.backlog is not None:
+                family('testinternet_delivery_backlog', 'gauge', 'Results not yet delivered by email/SCP')
+                lines.append('testinternet_delivery_backlog {}'.format(self.backlog))
+        return '\n'.join(lines) + '\n'
+
+
+class Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MetricsServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, metrics, port, host=''):
+        ThreadingHTTPServer.__init__(self, (host, port), Handler)
+        self.metrics = metrics
+
+    def start(self):
+        """Serves /metrics on a background thread"""
+        thread = threading.Thread(target=self.serve_forever, name='metrics')
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,276 @@
+"""SQLAlchemy models for db.sqlite. Imported only when testinternet.py needs the ORM, since loading SQLAlchemy is a large part of start-up time"""
+
+import time
+
+from sqlalchemy import create_engine, event, func, inspect, text, Column, ForeignKey, Index, Integer, String, Float, Boolean
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy.sql import null
+
+Base = declarative_base()
+class TestResult(Base):
+    __tablename__ = 'testresults'
+    id = Column(Integer, primary_key=True)
+    date = Column(Float, index=True)
+    ping = Column(Float, default=0)
+    upload = Column(Float, default=0)
+    download = Column(Float, default=0)
+    sent = Column(Boolean, default=False)
+    ping_min = Column(Float) # Latency probe stats, ms. ping is the average
+    ping_p95 = Column(Float)
+    jitter = Column(Float)
+    loss = Column(Float) # Fraction of latency probes that got no reply
+    download_streams = Column(Integer) # Parallel connections used for the download test
+    upload_streams = Column(Integer) # Parallel connections used for the upload test
+    download_samples = Column(String) # Throughput curve, see testinternet.encode_samples()
+    upload_samples = Column(String)
+    target = Column(String) # server:host or probe:host in a multi-target run (testinternet.py -tg/--targets). NULL for the chosen server
+    run_id = Column(Integer, ForeignKey('testruns.id')) # The TestRun of a -cv/--converge run
+    phases = relationship('PhaseTiming', back_populates='testresult')
+
+    def set_ping_only(self):
+        # null() rather than None, which would store the column default of 0
+        self.download = null()
+        self.upload = null()
+
+    def set_ping_lost(self):
+        """Every latency probe went unanswered, so there is no ping rather than a ping of 0"""
+        self.ping = null()
+
+    def add_phase(self, **kwargs):
+        self.phases.append(PhaseTiming(**kwargs))
+
+    def __repr__(self):
+        return '{{"date":{date},"ping":{ping},"upload":{upload},"download":{download}}}'.format(date=self.date, ping=self.ping, upload=self.upload, download=self.download)
+
+# Only unsent rows are in this index, so finding them costs the size of the backlog rather than the whole table
+Index('ix_testresults_unsent', TestResult.id, sqlite_where=TestResult.sent == False)
+
+def iter_rows(sess, criteria=(), after=0, chunk=500):
+    """Yields results with ids above after matching criteria as plain (id, date, ping, upload, download, target) rows, chunk at a time in id order. Nothing is kept in the session, so memory stays flat however many there are"""
+    last = after
+    while True:
+        rows = sess.query(TestResult.id, TestResult.date, TestResult.ping, TestResult.upload, TestResult.download, TestResult.target).filter(TestResult.id > last, *criteria).order_by(TestResult.id).limit(chunk).all()
+        for row in rows:
+            yield row
+        if len(rows) < chunk:
+            return
+        last = rows[-1].id
+
+def results_after(sess, after):
+    """(count, oldest date) of the results with ids above after"""
+    return sess.query(func.count(TestResult.id), func.min(TestResult.date)).filter(TestResult.id > after).one()
+
+class PhaseTiming(Base):
+    """Time spent in each phase by one connection of a ping, download or upload test"""
+    __tablename__ = 'phasetimings'
+    id = Column(Integer, primary_key=True)
+    testresult_id = Column(Integer, ForeignKey('testresults.id'))
+    testresult = relationship('TestResult', back_populates='phases')
+    kind = Column(String) # ping, download or upload
+    stream = Column(Integer)
+    requests = Column(Integer)
+    size = Column(Integer) # Bytes transferred
+    dns_ms = Column(Float)
+    connect_ms = Column(Float)
+    ttfb_ms = Column(Float) # Mean wait for the first byte of each response
+    transfer_ms = Column(Float)
+
+class ServerChoice(Base):
+    __tablename__ = 'serverchoice'
+    id = Column(Integer, primary_key=True)
+    date = Column(Float)
+    host = Column(String)
+    candidates = Column(String, default='') # Comma separated hosts, best first
+    ip = Column(String)
+    lat = Column(Float)
+    lon = Column(Float)
+
+    def candidate_list(self):
+        return [c for c in (self.candidates or '').split(',') if c]
+
+    def __repr__(self):
+        return '{{"date":{date},"host":"{host}","ip":"{ip}"}}'.format(date=self.date, host=self.host, ip=self.ip)
+
+class Watermark(Base):
+    """How far a delivery sink has got: the last result id it delivered"""
+    __tablename__ = 'watermarks'
+    id = Column(Integer, primary_key=True)
+    sink = Column(String, unique=True)
+    last_id = Column(Integer, default=0)
+    date = Column(Float)
+
+def watermark(sess, sink):
+    """The Watermark for sink. A new sink starts from the oldest result not yet marked sent"""
+    mark = sess.query(Watermark).filter(Watermark.sink == sink).first()
+    if mark is None:
+        first_unsent = sess.query(func.min(TestResult.id)).filter(TestResult.sent == False).scalar()
+        last_id = first_unsent - 1 if first_unsent is not None else sess.query(func.max(TestResult.id)).scalar() or 0
+        mark = Watermark(sink=sink, last_id=last_id, date=time.time())
+        sess.add(mark)
+        sess.commit()
+    return mark
+
+class OutboxBatch(Base):
+    """The results from first_id to last_id, going to one sink. Stored before it is first sent, so that a failed batch is retried with the same rows and batch_id"""
+    __tablename__ = 'outboxbatches'
+    id = Column(Integer, primary_key=True)
+    batch_id = Column(String, unique=True) # sink-first_id-last_id, also used in what the sink sends, so a resend can be recognised
+    sink = Column(String, index=True)
+    first_id = Column(Integer)
+    last_id = Column(Integer)
+    count = Column(Integer)
+    created = Column(Float)
+    attempts = Column(Integer, default=0)
+    next_attempt = Column(Float, default=0) # Not retried before this time
+    sent = Column(Float) # When it was delivered, NULL until then
+    error = Column(String) # From the last failed attempt
+    remote_path = Column(String) # File an appending sink writes the batch to, chosen before the first attempt
+    remote_size = Column(Integer) # Size of remote_path before the batch, so a retry can remove a partial append
+
+    def __repr__(self):
+        return '{{"batch_id":"{batch_id}","count":{count},"attempts":{attempts}}}'.format(batch_id=self.batch_id, count=self.count, attempts=self.attempts)
+
+def pending_batch(sess, sink):
+    return sess.query(OutboxBatch).filter(OutboxBatch.sink == sink, OutboxBatch.sent == None).order_by(OutboxBatch.id).first()
+
+def new_batch(sess, sink, after):
+    """Stores and returns a batch of all the results with ids above after, or None if there are none"""
+    count, first, last = sess.query(func.count(TestResult.id), func.min(TestResult.id), func.max(TestResult.id)).filter(TestResult.id > after).one()
+    if not count:
+        return None
+    batch = OutboxBatch(batch_id='{}-{}-{}'.format(sink, first, last), sink=sink, first_id=first, last_id=last, count=count, created=time.time(), attempts=0, next_attempt=0)
+    sess.add(batch)
+    sess.commit()
+    return batch
+
+def batch_rows(sess, batch):
+    return iter_rows(sess, [TestResult.id <= batch.last_id], after=batch.first_id - 1)
+
+def mark_sent_through(sess, last_id):
+    """Marks every result up to last_id as sent, and commits"""
+    sess.query(TestResult).filter(TestResult.sent == False, TestResult.id <= last_id).update({TestResult.sent: True}, synchronize_session=False)
+    sess.commit()
+    sess.expire_all()
+
+def session_factory(sess):
+    """Makes new sessions on the same database as sess, for use on other threads"""
+    return sessionmaker(bind=sess.get_bind())
+
+class IPChange(Base):
+    """Public or internal IP of this machine changing, or being seen for the first time (old is NULL)"""
+    __tablename__ = 'ipchanges'
+    id = Column(Integer, primary_key=True)
+    date = Column(Float, index=True)
+    kind = Column(String) # public or internal
+    old = Column(String)
+    new = Column(String)
+    source = Column(String) # What reported the new IP: speedtest, ipify or hostname
+
+    def __repr__(self):
+        return '{{"date":{date},"kind":"{kind}","old":"{old}","new":"{new}"}}'.format(date=self.date, kind=self.kind, old=self.old, new=self.new)
+
+def last_ip(sess, kind):
+    """The last recorded IP of kind, or None"""
+    change = sess.query(IPChange).filter(IPChange.kind == kind).order_by(IPChange.id.desc()).first()
+    return change.new if change is not None else None
+
+class TestRun(Base):
+    """How many iterations a testinternet.py -cv/--converge run of one target took, and how well that pinned down the
+    mean of each metric: error is the half-width of the 95% confidence interval, in the metric's units"""
+    __tablename__ = 'testruns'
+    id = Column(Integer, primary_key=True)
+    date = Column(Float, index=True) # When the run started
+    seconds = Column(Float)
+    target = Column(String) # Same as TestResult.target
+    iterations = Column(Integer)
+    converged = Column(Boolean) # False if the run stopped at -i/--iterations or -mt/--maxtime first
+    ping_mean = Column(Float)
+    ping_error = Column(Float)
+    download_mean = Column(Float)
+    download_error = Column(Float)
+    upload_mean = Column(Float)
+    upload_error = Column(Float)
+
+    def __repr__(self):
+        return '{{"date":{date},"target":"{target}","iterations":{iterations},"converged":{converged}}}'.format(date=self.date, target=self.target, iterations=self.iterations, converged=self.converged)
+
+class Rollup(Base):
+    """Aggregates of the results whose date falls in one hour or day. Each metric's count leaves out results without it, like ping-only tests for download/upload"""
+    __tablename__ = 'rollups'
+    id = Column(Integer, primary_key=True)
+    period = Column(String) # hour or day
+    start = Column(Float) # Timestamp the period starts at
+    target = Column(String) # Same as TestResult.target, each target is rolled up separately
+    count = Column(Integer) # Results in the period
+    compacted = Column(Boolean, default=False) # The raw results have been deleted, so this can't be recalculated from them
+    ping_count = Column(Integer)
+    ping_min = Column(Float)
+    ping_max = Column(Float)
+    ping_mean = Column(Float)
+    ping_p50 = Column(Float)
+    ping_p95 = Column(Float)
+    download_count = Column(Integer)
+    download_min = Column(Float)
+    download_max = Column(Float)
+    download_mean = Column(Float)
+    download_p50 = Column(Float)
+    download_p95 = Column(Float)
+    upload_count = Column(Integer)
+    upload_min = Column(Float)
+    upload_max = Column(Float)
+    upload_mean = Column(Float)
+    upload_p50 = Column(Float)
+    upload_p95 = Column(Float)
+
+    def __repr__(self):
+        return '{{"period":"{period}","start":{start},"target":"{target}","count":{count}}}'.format(period=self.period, start=self.start, target=self.target, count=self.count)
+
+Index('ix_rollups_period_start_target', Rollup.period, Rollup.start, Rollup.target, unique=True)
+
+# Indexes that older databases have, which were replaced by the ones above
+replaced_indexes = ['ix_rollups_period_start']
+
+def add_missing_columns(engine):
+    """create_all() doesn't alter existing tables, so add any columns that older databases are missing"""
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = set(c['name'] for c in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in existing:
+                with engine.begin() as conn:
+                    conn.execute(text('ALTER TABLE {table} ADD COLUMN {column} {type}'.format(table=table.name, column=column.name, type=column.type.compile(engine.dialect))))
+
+def add_missing_indexes(engine):
+    """create_all() only makes indexes for new tables"""
+    with engine.begin() as conn:
+        for name in replaced_indexes:
+            conn.execute(text('DROP INDEX IF EXISTS {}'.format(name)))
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+
+sqlite_pragmas = [
+    'PRAGMA journal_mode=WAL', # Readers don't block the writer, and commits don't rewrite the whole journal
+    'PRAGMA synchronous=NORMAL', # Safe with WAL, and avoids an fsync on every commit
+    'PRAGMA busy_timeout=5000', # Wait for the daemon or another run instead of failing with "database is locked"
+    'PRAGMA temp_store=MEMORY',
+]
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma in sqlite_pragmas:
+        cursor.execute(pragma)
+    cursor.close()
+
+def init_db(url):
+    engine = create_engine(url)
+    if engine.dialect.name == 'sqlite':
+        event.listen(engine, 'connect', set_sqlite_pragmas)
+    add_missing_columns(engine)
+    Base.metadata.create_all(engine)
+    add_missing_indexes(engine)
+    DBSession = sessionmaker(bind=engine)
+    return DBSession()
@@ -0,0 +1,87 @@
+"""Caches this machine's public and internal IP for testinternet.py, so that reports don't look them up every time, and records changes as IPChange events"""
+
+import threading
+import time
+
+
+class NetworkIdentity(object):
+    """The public IP is taken from whatever saw it last, usually the speedtest config fetched when choosing a server, and
+    otherwise looked up with lookup_public(). The internal IP comes from lookup_internal(). Once the public IP is older than
+    ttl seconds, the last known one is still returned while a new lookup runs in the background, so reports never wait on it"""
+
+    def __init__(self, lookup_public, lookup_internal, session_factory=None, ttl=60 * 60):
+        """session_factory, if given, makes the sessions used to record IPChange events and to find the last known IPs"""
+        self.lookup_public = lookup_public
+        self.lookup_internal = lookup_internal
+        self.session_factory = session_factory
+        self.ttl = ttl
+        self.ips = {} # kind: (ip, time seen)
+        self.lock = threading.Lock()
+        self.record_lock = threading.Lock() # So that sinks delivering at once don't record the same change twice
+        self.refreshing = None
+
+    def observe(self, kind, ip, source):
+        """Remembers ip as the current IP of kind (public or internal), recording an event if it changed"""
+        with self.record_lock:
+            old = self.ips.get(kind, (None, 0))[0]
+            self.ips[kind] = (ip, time.time())
+            if self.session_factory is None:
+                return
+            from models import IPChange, last_ip
+            sess = self.session_factory()
+            try:
+                if old is None:
+                    old = last_ip(sess, kind)
+                if old != ip:
+                    print("{} IP is now {} (was {})".format(kind.capitalize(), ip, old))
+                    sess.add(IPChange(date=time.time(), kind=kind, old=old, new=ip, source=source))
+                    sess.commit()
+            finally:
+                sess.close()
+
+    def fresh(self, kind):
+        ip, seen = self.ips.get(kind, (None, 0))
+        return ip is not None and time.time() - seen <= self.ttl
+
+    def known(self, kind):
+        """Cached IP of kind even if stale, or else the last one recorded, or None"""
+        ip = self.ips.get(kind, (None, 0))[0]
+        if ip is None and self.session_factory is not None:
+            from models import last_ip
+            sess = self.session_factory()
+            try:
+                ip = last_ip(sess, kind)
+            finally:
+                sess.close()
+        return ip
+
+    def refresh(self):
+        try:
+            self.observe('public', self.lookup_public(), 'ipify')
+        except Exception as e:
+            print('Could not look up public IP')
+            print(e)
+
+    def prefetch(self):
+        """Starts looking up the public IP in the background if the cached one is stale"""
+        with self.lock:
+            if self.fresh('public') or (self.refreshing is not None and self.refreshing.is_alive()):
+                return self.refreshing
+            self.refreshing = threading.Thread(target=self.refresh, name='public ip')
+            self.refreshing.daemon = True
+            self.refreshing.start()
+            return self.refreshing
+
+    def public_ip(self, wait=2):
+        """If no public IP has ever been seen, waits up to wait seconds for the lookup"""
+        refreshing = self.prefetch()
+        ip = self.known('public')
+        if ip is None and refreshing is not None:
+            refreshing.join(wait)
+            ip = self.known('public')
+        return ip or 'unknown'
+
+    def internal_ip(self):
+        if not self.fresh('internal'):
+            self.observe('internal', self.lookup_internal(), 'hostname')
+        return self.ips['internal'][0]
@@ -0,0 +1,96 @@
+"""Delivers results to every sink (email, SCP, SFTP) independently, for testinternet.py. Each sink has its own watermark and
+sends numbered batches that are stored before they're sent, so a failed batch is retried later with the same rows and
+batch_id, and a slow or failing sink never holds up the others"""
+
+import random
+import threading
+import time
+
+from models import mark_sent_through, new_batch, pending_batch, results_after, watermark
+
+
+class Sink(object):
+    def __init__(self, name, send, batch_rows, max_wait):
+        self.name = name
+        self.send = send
+        self.batch_rows = batch_rows
+        self.max_wait = max_wait
+
+
+class Outbox(object):
+    """Sinks are run on their own threads, each with its own database session"""
+
+    # Seconds to wait before retrying a failed batch, doubled for each failure in a row up to MAX_BACKOFF
+    BACKOFF = 60
+    MAX_BACKOFF = 6 * 60 * 60
+
+    def __init__(self, session_factory):
+        self.session_factory = session_factory
+        self.sinks = []
+
+    def add(self, name, send, batch_rows=1, max_wait=0):
+        """send(sess, batch) delivers the results in batch (a models.OutboxBatch), raising if it can't. Since a batch that
+        was delivered but not recorded as sent is sent again, receivers should use batch.batch_id to recognise repeats.
+        New batches wait until batch_rows results are waiting, or the oldest has waited max_wait seconds"""
+        sink = Sink(name, send, batch_rows, max_wait)
+        self.sinks.append(sink)
+        return sink
+
+    def due(self, sess, sink, mark):
+        count, oldest = results_after(sess, mark.last_id)
+        if not count:
+            return False
+        return count >= sink.batch_rows or time.time() - oldest >= sink.max_wait
+
+    def deliver_sink(self, sink):
+        """Sends the sink's failed batch if it is due for a retry, or else a new batch if enough results are waiting"""
+        sess = self.session_factory()
+        try:
+            mark = watermark(sess, sink.name)
+            batch = pending_batch(sess, sink.name)
+            if batch is None:
+                if not self.due(sess, sink, mark):
+                    return
+                batch = new_batch(sess, sink.name, mark.last_id)
+            elif time.time() < batch.next_attempt:
+                print("{} batch {} waiting {:.0f}s to retry".format(sink.name, batch.batch_id, batch.next_attempt - time.time()))
+                return
+            try:
+                sink.send(sess, batch)
+            except Exception as e:
+                sess.rollback()
+                batch.attempts += 1
+                delay = min(self.MAX_BACKOFF, self.BACKOFF * 2 ** (batch.attempts - 1))
+                batch.next_attempt = time.time() + random.uniform(delay / 2, delay)
+                batch.error = str(e)
+                sess.commit()
+                print("{} batch {} failed, retrying in {:.0f}s".format(sink.name, batch.batch_id, batch.next_attempt - time.time()))
+                print(e)
+                return
+            batch.attempts += 1
+            batch.sent = time.time()
+            batch.error = None
+            mark.last_id = max(mark.last_id, batch.last_id)
+            mark.date = batch.sent
+            sess.commit()
+            print("{} sent batch {} of {} results".format(sink.name, batch.batch_id, batch.count))
+        except Exception as e:
+            print("{} delivery failed".format(sink.name))
+            print(e)
+        finally:
+            sess.close()
+
+    def deliver(self):
+        """Runs every sink at once and waits for them all. Results that every sink has delivered are then marked sent"""
+        threads = [threading.Thread(target=self.deliver_sink, args=(sink,), name=sink.name) for sink in self.sinks]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if not self.sinks:
+            return
+        sess = self.session_factory()
+        try:
+            mark_sent_through(sess, min(watermark(sess, sink.name).last_id for sink in self.sinks))
+        finally:
+            sess.close()
@@ -7,29 +7,29 @@
 from __future__ import print_function
 
 import argparse
-import bisect
+import heapq
 import itertools
 import logging
 import random
 import re
+import socket
 import string
 import sys
+import errno
 import platform
+import select
 
-from math import sqrt
-from threading import currentThread, Thread
-from time import time
+from collections import namedtuple
+from math import asin, cos, radians, sin, sqrt
+from threading import currentThread, Event, Lock, Thread
+from time import sleep, time
+from xml.etree import ElementTree
 
 try:
     from httplib import HTTPConnection
 except ImportError:
     from http.client import HTTPConnection
 
-try:
-    from urllib import urlencode
-except ImportError:
-    from urllib.parse import urlencode
-
 __program__ = 'pyspeedtest'
 __version__ = '1.2.7'
 __description__ = 'Test your bandwidth speed using Speedtest.net servers.'
@@ -57,12 +57,66 @@ class SpeedTest(object):
         493638
     ]
 
+    # Payload sizes used, smallest first, when a test duration is set
+    DOWNLOAD_SIZES = [350, 500, 750, 1000, 1500, 2000, 2500, 3000, 3500, 4000]
+
+    UPLOAD_SIZES = [
+        132884,
+        493638,
+        1000000,
+        2000000,
+        4000000,
+        8000000
+    ]
+
     ALPHABET = string.digits + string.ascii_letters
 
-    def __init__(self, host=None, http_debug=0, runs=2):
+    # Bytes read from the socket at a time when downloading
+    READ_BUFFER = 64 * 1024
+
+    # Bytes sent to the socket at a time when uploading
+    WRITE_CHUNK = 64 * 1024
+
+    # Seconds between samples of the bytes transferred so far
+    SAMPLE_INTERVAL = 0.1
+
+    # Minimum throughput gain needed to keep adding connections
+    SCALE_GAIN = 1.1
+
+    # Number of nearest servers that are probed when choosing a server
+    CANDIDATES = 10
+
+    # Seconds allowed for probing all candidates
+    PROBE_DEADLINE = 5
+
+    # Host serving speedtest-config.php and speedtest-servers.php
+    CONFIG_HOST = 'c.speedtest.net'
+
+    def __init__(self, host=None, http_debug=0, runs=2, duration=None,
+                 max_runs=None, skip_warmup=False, engine='thread',
+                 processes=1, pool=None):
         self._host = host
         self.http_debug = http_debug
         self.runs = runs
+        self.duration = duration
+        self.max_runs = max_runs
+        self.skip_warmup = skip_warmup
+        # 'thread', or 'asyncio' to delegate to aiospeedtest. The asyncio
+        # engine doesn't record RequestTimings or support duration.
+        self.engine = engine
+        # worker processes that download/upload connections are spread over
+        self.processes = processes
+        # ConnectionPool to reuse connections across tests, or None to open
+        # a fresh (cold) connection for each one. Processes and the asyncio
+        # engine always use their own connections.
+        self.pool = pool
+        self.used_runs = {}
+        # (seconds since start, total bytes) for the last download/upload
+        self.samples = {}
+        # RequestTimings per connection for the last ping/download/upload
+        self.timings = {}
+        # called with every RequestTiming as it is recorded
+        self.timing_hook = None
 
     @property
     def host(self):
@@ -74,34 +128,132 @@ class SpeedTest(object):
     def host(self, new_host):
         self._host = new_host
 
-    def connect(self, url):
+    def connect(self, url, timeout=None):
         try:
-            connection = HTTPConnection(url)
+            connection = HTTPConnection(url, timeout=timeout)
             connection.set_debuglevel(self.http_debug)
-            connection.connect()
-            return connection
+            # resolve and connect here rather than in connection.connect()
+            # so that the two can be timed separately
+            start = time()
+            addresses = socket.getaddrinfo(
+                connection.host, connection.port, 0, socket.SOCK_STREAM)
+            resolved = time()
+            connection.sock = opensocket(addresses, timeout)
+            connected = time()
         except:
             raise Exception('Unable to connect to %r' % url)
-
-    def downloadthread(self, connection, url):
+        connection.host_key = url
+        connection.dns_ms = (resolved - start) * 1000
+        connection.connect_ms = (connected - resolved) * 1000
+        connection.timings = []
+        # false while a request is in progress, so a connection left
+        # mid-request by an error isn't handed out again
+        connection.finished = True
+        # reused by every download on this connection
+        connection.readbuffer = memoryview(bytearray(self.READ_BUFFER))
+        return connection
+
+    def acquire(self, host):
+        """Return a connection to host, from the pool if there is one."""
+        if self.pool is None:
+            return self.connect(host)
+        return self.pool.acquire(host, self.connect)
+
+    def release(self, connection):
+        """Return a connection to the pool, or close it."""
+        if self.pool is None or not connection.finished:
+            connection.close()
+        else:
+            self.pool.release(connection)
+
+    def timerequest(self, connection, ttfb, transfer, size):
+        """Record a RequestTiming for a request made on connection. DNS and
+        connect times are only charged to the first request."""
+        first = not connection.timings
+        timing = RequestTiming(
+            connection.host,
+            connection.dns_ms if first else 0,
+            connection.connect_ms if first else 0,
+            ttfb * 1000,
+            transfer * 1000,
+            size)
+        connection.timings.append(timing)
+        connection.finished = True
+        if self.timing_hook is not None:
+            self.timing_hook(timing)
+
+    def streamtimings(self, kind):
+        """Summarise the requests made on each connection by the last
+        'ping', 'download' or 'upload' as a list of dicts, one per stream."""
+        streams = []
+        for number, timings in enumerate(self.timings.get(kind, []), 1):
+            if not timings:
+                continue
+            streams.append({
+                'stream': number,
+                'requests': len(timings),
+                'size': sum(t.size for t in timings),
+                'dns_ms': sum(t.dns_ms for t in timings),
+                'connect_ms': sum(t.connect_ms for t in timings),
+                'ttfb_ms': sum(t.ttfb_ms for t in timings) / len(timings),
+                'transfer_ms': sum(t.transfer_ms for t in timings),
+            })
+        return streams
+
+    def get(self, connection, url, progress=None):
+        """Download url, counting the bytes as they arrive without keeping
+        them. progress, if given, is called with the size of each chunk."""
+        start = time()
+        connection.finished = False
         connection.request('GET', url, None, {'Connection': 'Keep-Alive'})
         response = connection.getresponse()
+        first_byte = time()
+        buf = connection.readbuffer
+        downloaded = 0
+        while True:
+            count = response.readinto(buf)
+            if not count:
+                break
+            downloaded += count
+            if progress is not None:
+                progress(count)
+        self.timerequest(
+            connection, first_byte - start, time() - first_byte, downloaded)
+        return downloaded
+
+    def downloadthread(self, connection, url, progress=None):
         self_thread = currentThread()
-        self_thread.downloaded = len(response.read())
+        self_thread.downloaded = self.get(connection, url, progress)
 
     def download(self):
+        return self.scaleruns('download', self.rundownload)
+
+    def rundownload(self, runs):
+        if self.processes > 1:
+            return self.processtransfer('download', runs)
+        if self.engine == 'asyncio' and not self.duration:
+            return self.asynctransfer('download', runs)
+        if self.duration:
+            return self.timedtransfer(
+                'download',
+                lambda connection, size, progress: self.get(
+                    connection, '/speedtest/random%dx%d.jpg?x=%d' % (
+                        size, size, int(time() * 1000)), progress),
+                SpeedTest.DOWNLOAD_SIZES, runs)
         total_downloaded = 0
         connections = [
-            self.connect(self.host) for i in range(self.runs)
+            self.acquire(self.host) for i in range(runs)
         ]
-        total_start_time = time()
+        sampler = ThroughputSampler(self.SAMPLE_INTERVAL)
+        total_start_time = sampler.start()
         for current_file in SpeedTest.DOWNLOAD_FILES:
             threads = []
-            for run in range(self.runs):
+            for run in range(runs):
                 thread = Thread(
                     target=self.downloadthread,
                     args=(connections[run],
-                          '%s?x=%d' % (current_file, int(time() * 1000))))
+                          '%s?x=%d' % (current_file, int(time() * 1000)),
+                          sampler.add))
                 thread.run_number = run + 1
                 thread.start()
                 threads.append(thread)
@@ -111,39 +263,75 @@ class SpeedTest(object):
                 LOG.debug('Run %d for %s finished',
                           thread.run_number, current_file)
         total_ms = (time() - total_start_time) * 1000
+        sampler.stop()
+        self.samples['download'] = sampler.samples
+        self.timings['download'] = [c.timings for c in connections]
         for connection in connections:
-            connection.close()
+            self.release(connection)
         LOG.info('Took %d ms to download %d bytes',
                  total_ms, total_downloaded)
-        return total_downloaded * 8000 / total_ms
+        return self.headline('download', total_downloaded * 8000 / total_ms)
 
-    def uploadthread(self, connection, data):
+    def post(self, connection, data, progress=None):
+        """Upload data, sending it in WRITE_CHUNK slices. progress, if given,
+        is called with the size of each slice once it has been sent."""
         url = '/speedtest/upload.php?x=%d' % randint()
-        connection.request('POST', url, data, {
-            'Connection': 'Keep-Alive',
-            'Content-Type': 'application/x-www-form-urlencoded'
-        })
+        data = memoryview(data)
+        start = time()
+        connection.finished = False
+        connection.putrequest('POST', url)
+        connection.putheader('Connection', 'Keep-Alive')
+        connection.putheader(
+            'Content-Type', 'application/x-www-form-urlencoded')
+        connection.putheader('Content-Length', str(len(data)))
+        connection.endheaders()
+        for offset in range(0, len(data), self.WRITE_CHUNK):
+            chunk = data[offset:offset + self.WRITE_CHUNK]
+            connection.send(chunk)
+            if progress is not None:
+                progress(len(chunk))
+        sent = time()
         response = connection.getresponse()
+        first_byte = time()
         reply = response.read().decode('utf-8')
+        uploaded = int(reply.split('=')[1])
+        # for uploads the transfer is the time spent sending the body
+        self.timerequest(connection, first_byte - sent, sent - start, uploaded)
+        return uploaded
+
+    def uploadthread(self, connection, data, progress=None):
         self_thread = currentThread()
-        self_thread.uploaded = int(reply.split('=')[1])
+        self_thread.uploaded = self.post(connection, data, progress)
 
     def upload(self):
+        return self.scaleruns('upload', self.runupload)
+
+    def runupload(self, runs):
+        if self.processes > 1:
+            return self.processtransfer('upload', runs)
+        if self.engine == 'asyncio' and not self.duration:
+            return self.asynctransfer('upload', runs)
+        if self.duration:
+            payload(max(SpeedTest.UPLOAD_SIZES))  # build it before timing
+            return self.timedtransfer(
+                'upload',
+                lambda connection, size, progress: self.post(
+                    connection, payload(size), progress),
+                SpeedTest.UPLOAD_SIZES, runs)
         connections = [
-            self.connect(self.host) for i in range(self.runs)
+            self.acquire(self.host) for i in range(runs)
         ]
 
-        post_data = [
-            urlencode({'content0': content(s)}) for s in SpeedTest.UPLOAD_FILES
-        ]
+        post_data = [payload(s) for s in SpeedTest.UPLOAD_FILES]
 
         total_uploaded = 0
-        total_start_time = time()
+        sampler = ThroughputSampler(self.SAMPLE_INTERVAL)
+        total_start_time = sampler.start()
         for data in post_data:
             threads = []
-            for run in range(self.runs):
+            for run in range(runs):
                 thread = Thread(target=self.uploadthread,
-                                args=(connections[run], data))
+                                args=(connections[run], data, sampler.add))
                 thread.run_number = run + 1
                 thread.start()
                 threads.append(thread)
@@ -153,54 +341,232 @@ class SpeedTest(object):
                           thread.run_number, thread.uploaded)
                 total_uploaded += thread.uploaded
         total_ms = (time() - total_start_time) * 1000
+        sampler.stop()
+        self.samples['upload'] = sampler.samples
+        self.timings['upload'] = [c.timings for c in connections]
         for connection in connections:
-            connection.close()
+            self.release(connection)
         LOG.info('Took %d ms to upload %d bytes',
                  total_ms, total_uploaded)
-        return total_uploaded * 8000 / total_ms
-
-    def ping(self, server=None):
-        if not server:
+        return self.headline('upload', total_uploaded * 8000 / total_ms)
+
+    def runasync(self, name, *args):
+        """Run AsyncSpeedTest.<name>(*args) to completion."""
+        import asyncio
+        from aiospeedtest import AsyncSpeedTest
+        tester = AsyncSpeedTest(self._host, self.runs)
+        return asyncio.run(getattr(tester, name)(*args))
+
+    def asynctransfer(self, kind, runs):
+        sampler = ThroughputSampler(self.SAMPLE_INTERVAL)
+        sampler.start()
+        try:
+            speed = self.runasync(kind, runs, sampler.add)
+        finally:
+            sampler.stop()
+        self.samples[kind] = sampler.samples
+        self.timings[kind] = []
+        return self.headline(kind, speed)
+
+    def processtransfer(self, kind, runs):
+        """Spread runs connections over self.processes worker processes that
+        start together, and add up their throughput."""
+        import multiprocessing
+        processes = min(self.processes, runs)
+        shares = [runs // processes + (1 if i < runs % processes else 0)
+                  for i in range(processes)]
+        barrier = multiprocessing.Barrier(processes)
+        workers = []
+        for share in shares:
+            receiver, sender = multiprocessing.Pipe(False)
+            worker = multiprocessing.Process(
+                target=transferworker,
+                args=(sender, barrier, self.host, kind, share, self.duration,
+                      self.skip_warmup, self.engine))
+            worker.daemon = True
+            worker.start()
+            sender.close()
+            workers.append((worker, receiver))
+        results = []
+        for worker, receiver in workers:
+            try:
+                results.append(receiver.recv())
+            except EOFError:
+                results.append(Exception('Worker process %d died' % worker.pid))
+            worker.join()
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        self.samples[kind] = mergesamples([samples for _, samples, _ in results])
+        self.timings[kind] = [
+            timings for _, _, stream_timings in results
+            for timings in stream_timings or []]
+        return sum(speed for speed, _, _ in results)
+
+    def scaleruns(self, name, measure):
+        """Return measure(runs) for self.runs parallel connections.
+
+        If max_runs is set, keep doubling the number of connections until the
+        throughput improves by less than SCALE_GAIN or max_runs is reached,
+        and return the best throughput seen. The number of connections used
+        is recorded in self.used_runs[name]."""
+        runs = self.runs
+        best_speed, best_runs = measure(runs), runs
+        best_timings = self.timings.get(name)
+        best_samples = self.samples.get(name)
+        while self.max_runs and runs < self.max_runs:
+            runs = min(runs * 2, self.max_runs)
+            speed = measure(runs)
+            LOG.debug('%s with %d runs: %d bps', name, runs, speed)
+            if speed > best_speed:
+                gained = speed >= best_speed * self.SCALE_GAIN
+                best_speed, best_runs = speed, runs
+                best_timings = self.timings.get(name)
+                best_samples = self.samples.get(name)
+                if gained:
+                    continue
+            break
+        self.used_runs[name] = best_runs
+        self.timings[name] = best_timings
+        self.samples[name] = best_samples
+        return best_speed
+
+    def headline(self, kind, speed):
+        """Return speed, or the steady-state rate of the sampled curve if
+        skip_warmup is set and enough samples were taken."""
+        if self.skip_warmup:
+            stats = curvestats(self.samples.get(kind))
+            if stats:
+                return stats['steady']
+        return speed
+
+    def curve(self, kind):
+        """Return the sampled throughput of the last 'download' or 'upload'
+        as a list of (seconds since start, bits per second)."""
+        return samplerates(self.samples.get(kind))
+
+    def timedtransfer(self, kind, transfer, sizes, runs):
+        """Call transfer(connection, size, progress) repeatedly on every connection
+        until self.duration seconds have passed, moving on to the next size
+        whenever a request takes less than a tenth of the budget.
+
+        Return the throughput in bits per second over the window after every
+        connection has finished its first (slow start) request."""
+        connections = [
+            self.acquire(self.host) for i in range(runs)
+        ]
+        sampler = ThroughputSampler(self.SAMPLE_INTERVAL)
+        end_time = sampler.start() + self.duration
+        grow_below = self.duration / 10.0
+
+        def stream(connection):
+            self_thread = currentThread()
+            size = 0
+            while time() < end_time:
+                start = time()
+                transferred = transfer(connection, sizes[size], sampler.add)
+                stop = time()
+                self_thread.requests.append((start, stop, transferred))
+                if stop - start < grow_below and size < len(sizes) - 1:
+                    size += 1
+
+        threads = []
+        for run in range(runs):
+            thread = Thread(target=stream, args=(connections[run],))
+            thread.run_number = run + 1
+            thread.requests = []
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+            LOG.debug('Run %d made %d requests',
+                      thread.run_number, len(thread.requests))
+        sampler.stop()
+        self.samples[kind] = sampler.samples
+        self.timings[kind] = [c.timings for c in connections]
+        for connection in connections:
+            self.release(connection)
+        requests = [r for thread in threads for r in thread.requests]
+        if not requests:
+            raise Exception('No transfers completed')
+        window_start = max(
+            thread.requests[0][1] for thread in threads if thread.requests)
+        window_end = max(stop for start, stop, transferred in requests)
+        if window_end <= window_start:
+            # every connection only managed one request, use all of them
+            window_start = min(start for start, stop, transferred in requests)
+        total_transferred = 0
+        for start, stop, transferred in requests:
+            overlap = min(stop, window_end) - max(start, window_start)
+            if overlap > 0:
+                total_transferred += transferred * overlap / (stop - start)
+        total_ms = (window_end - window_start) * 1000
+        LOG.info('Transferred %d bytes in a %d ms steady-state window',
+                 total_transferred, total_ms)
+        return self.headline(kind, total_transferred * 8000 / total_ms)
+
+    def ping(self, server=None, timeout=None):
+        if self.engine == 'asyncio':
+            return self.runasync('ping', server or self.host, timeout)
+        own_host = not server
+        if own_host:
             server = self.host
 
-        connection = self.connect(server)
+        if own_host:
+            connection = self.acquire(server)
+        else:
+            connection = self.connect(server, timeout)
         times = []
         worst = 0
         for _ in range(5):
             total_start_time = time()
+            connection.finished = False
             connection.request(
                 'GET',
                 '/speedtest/latency.txt?x=%d' % randint(),
                 None,
                 {'Connection': 'Keep-Alive'})
             response = connection.getresponse()
-            response.read()
+            first_byte = time()
+            size = len(response.read())
+            self.timerequest(connection, first_byte - total_start_time,
+                             time() - first_byte, size)
             total_ms = time() - total_start_time
             times.append(total_ms)
             if total_ms > worst:
                 worst = total_ms
         times.remove(worst)
         total_ms = sum(times) * 250  # * 1000 / number of tries (4) = 250
-        connection.close()
+        if own_host:
+            # candidate probes while choosing a server aren't recorded
+            self.timings['ping'] = [connection.timings]
+            self.release(connection)
+        else:
+            connection.close()
         LOG.debug('Latency for %s - %d', server, total_ms)
         return total_ms
 
-    def chooseserver(self):
-        connection = self.connect('c.speedtest.net')
-        now = int(time() * 1000)
+    def _speedtestnet(self):
+        connection = self.connect(self.CONFIG_HOST)
         # really contribute to speedtest.net OS statistics
         # maybe they won't block us again...
         extra_headers = {
             'Connection': 'Keep-Alive',
             'User-Agent': self.USER_AGENTS.get(platform.system(), self.USER_AGENTS['Linux'])
         }
+        return connection, extra_headers
+
+    def clientinfo(self):
+        """Return (ip, lat, lon) as reported by speedtest.net, or None."""
+        connection, extra_headers = self._speedtestnet()
         connection.request(
-            'GET', '/speedtest-config.php?x=%d' % now, None, extra_headers)
+            'GET', '/speedtest-config.php?x=%d' % int(time() * 1000), None,
+            extra_headers)
         response = connection.getresponse()
         reply = response.read().decode('utf-8')
+        connection.close()
         match = re.search(
             r'<client ip="([^"]*)" lat="([^"]*)" lon="([^"]*)"', reply)
-        location = None
         if match is None:
             LOG.info('Failed to retrieve coordinates')
             return None
@@ -208,35 +574,410 @@ class SpeedTest(object):
         LOG.info('Your IP: %s', location[0])
         LOG.info('Your latitude: %s', location[1])
         LOG.info('Your longitude: %s', location[2])
+        return location
+
+    def rankservers(self, location=None):
+        """Return the hosts of the nearest servers, lowest latency first."""
+        if location is None:
+            location = self.clientinfo()
+        if location is None:
+            return []
+        connection, extra_headers = self._speedtestnet()
         connection.request(
-            'GET', '/speedtest-servers.php?x=%d' % now, None, extra_headers)
+            'GET', '/speedtest-servers.php?x=%d' % int(time() * 1000), None,
+            extra_headers)
         response = connection.getresponse()
-        reply = response.read().decode('utf-8')
-        server_list = re.findall(
-            r'<server url="([^"]*)" lat="([^"]*)" lon="([^"]*)"', reply)
         my_lat = float(location[1])
         my_lon = float(location[2])
-        sorted_server_list = []
-        for server in server_list:
-            s_lat = float(server[1])
-            s_lon = float(server[2])
-            distance = sqrt(pow(s_lat - my_lat, 2) + pow(s_lon - my_lon, 2))
-            bisect.insort_left(sorted_server_list, (distance, server[0]))
-        best_server = (999999, '')
-        for server in sorted_server_list[:10]:
-            LOG.debug(server[1])
-            match = re.search(
-                r'http://([^/]+)/speedtest/upload\.php', server[1])
-            if match is None:
-                continue
-            server_host = match.groups()[0]
-            latency = self.ping(server_host)
-            if latency < best_server[0]:
-                best_server = (latency, server_host)
-        if not best_server[1]:
+        nearest = []
+        for url, s_lat, s_lon in iterservers(response):
+            entry = (-distance(my_lat, my_lon, s_lat, s_lon), url)
+            if len(nearest) < self.CANDIDATES:
+                heapq.heappush(nearest, entry)
+            elif entry > nearest[0]:
+                heapq.heapreplace(nearest, entry)
+        connection.close()
+        hosts = []
+        for _, url in sorted(nearest, reverse=True):
+            LOG.debug(url)
+            match = re.search(r'http://([^/]+)/speedtest/upload\.php', url)
+            if match is not None:
+                hosts.append(match.groups()[0])
+        return self.probeservers(hosts)
+
+    def probeservers(self, hosts, deadline=None):
+        """Ping all hosts at once, returning those that answered in time,
+        lowest latency first."""
+        if deadline is None:
+            deadline = self.PROBE_DEADLINE
+        ranked = []
+
+        def probe(server_host):
+            try:
+                ranked.append((self.ping(server_host, timeout=deadline),
+                               server_host))
+            except Exception:
+                LOG.debug('Skipping unreachable server %s', server_host)
+
+        threads = []
+        for server_host in hosts:
+            thread = Thread(target=probe, args=(server_host,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        end_time = time() + deadline
+        for thread in threads:
+            thread.join(max(0, end_time - time()))
+        ranked = sorted(ranked)
+        return [server_host for latency, server_host in ranked]
+
+    def chooseserver(self):
+        if self.engine == 'asyncio':
+            return self.runasync('chooseserver')
+        ranked = self.rankservers()
+        if not ranked:
             raise Exception('Cannot find a test server')
-        LOG.debug('Best server: %s', best_server[1])
-        return best_server[1]
+        LOG.debug('Best server: %s', ranked[0])
+        return ranked[0]
+
+
+class LatencyProbe(object):
+    """Measure round trip times to a host from inside the process, with
+    bursts of TCP connects ('tcp') or UDP echo requests ('udp')."""
+
+    def __init__(self, host, port=None, protocol='tcp', count=10,
+                 interval=0.2, timeout=1.0):
+        self.host = host
+        self.protocol = protocol
+        self.port = port or (7 if protocol == 'udp' else 80)
+        self.count = count
+        self.interval = interval
+        self.timeout = timeout
+        self._address = None
+
+    def address(self):
+        # resolved once, so DNS isn't part of any sample
+        if self._address is None:
+            socktype = (socket.SOCK_DGRAM if self.protocol == 'udp'
+                        else socket.SOCK_STREAM)
+            family, _, _, _, address = socket.getaddrinfo(
+                self.host, self.port, 0, socktype)[0]
+            self._address = (family, address)
+        return self._address
+
+    def probe(self, sequence=0):
+        """Return one round trip time in ms, or None if it was lost."""
+        family, address = self.address()
+        if self.protocol == 'udp':
+            return self._udpprobe(family, address, sequence)
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            start = time()
+            try:
+                sock.connect(address)
+            except socket.timeout:
+                return None
+            except socket.error as e:
+                # a refused connection is still a reply from the host
+                if e.errno != errno.ECONNREFUSED:
+                    return None
+            return (time() - start) * 1000
+        finally:
+            sock.close()
+
+    def _udpprobe(self, family, address, sequence):
+        sock = socket.socket(family, socket.SOCK_DGRAM)
+        sock.settimeout(self.timeout)
+        message = ('%s %d %d' % (__program__, sequence, randint())).encode()
+        try:
+            start = time()
+            sock.sendto(message, address)
+            while True:
+                remaining = self.timeout - (time() - start)
+                if remaining <= 0:
+                    return None
+                sock.settimeout(remaining)
+                try:
+                    reply = sock.recv(len(message) + 1)
+                except (socket.timeout, socket.error):
+                    return None
+                if reply == message:
+                    return (time() - start) * 1000
+        finally:
+            sock.close()
+
+    def burst(self):
+        """Send count probes, interval seconds apart, and return a dict of
+        min/avg/p95/jitter in ms and loss as a fraction, or None for the
+        times if every probe was lost."""
+        rtts = []
+        lost = 0
+        start = time()
+        for sequence in range(self.count):
+            wait = start + sequence * self.interval - time()
+            if wait > 0:
+                sleep(wait)
+            rtt = self.probe(sequence)
+            if rtt is None:
+                lost += 1
+            else:
+                rtts.append(rtt)
+        stats = {'sent': self.count, 'loss': float(lost) / self.count,
+                 'min': None, 'avg': None, 'p95': None, 'jitter': None}
+        if rtts:
+            stats['min'] = min(rtts)
+            stats['avg'] = sum(rtts) / len(rtts)
+            stats['p95'] = percentile(rtts, 0.95)
+            # mean difference between consecutive replies
+            stats['jitter'] = (
+                sum(abs(b - a) for a, b in zip(rtts, rtts[1:])) /
+                (len(rtts) - 1) if len(rtts) > 1 else 0.0)
+        LOG.debug('Latency burst to %s:%d - %r', self.host, self.port, stats)
+        return stats
+
+
+class ConnectionPool(object):
+    """Idle keep-alive connections, by host, that can be shared by several
+    SpeedTests."""
+
+    def __init__(self, max_idle=16):
+        self.max_idle = max_idle
+        self.idle = {}
+        self._lock = Lock()
+
+    def acquire(self, host, connect):
+        """Return a live idle connection to host, or connect(host)."""
+        while True:
+            with self._lock:
+                idle = self.idle.get(host)
+                connection = idle.pop() if idle else None
+            if connection is None:
+                return connect(host)
+            if isalive(connection):
+                # setup was paid for by an earlier test
+                connection.timings = []
+                connection.dns_ms = connection.connect_ms = 0
+                return connection
+            LOG.debug('Dropping dead pooled connection to %s', host)
+            connection.close()
+
+    def release(self, connection):
+        with self._lock:
+            idle = self.idle.setdefault(connection.host_key, [])
+            if len(idle) < self.max_idle:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        with self._lock:
+            idle, self.idle = self.idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+
+def isalive(connection):
+    """True if an idle connection's socket is still open. The server has
+    nothing to send on an idle keep-alive connection, so a readable socket
+    means it was closed."""
+    if connection.sock is None:
+        return False
+    try:
+        readable, _, _ = select.select([connection.sock], [], [], 0)
+    except (ValueError, socket.error):
+        return False
+    return not readable
+
+
+class ThroughputSampler(object):
+    """Count bytes reported from any number of threads, and record the
+    running total every interval seconds from a background thread."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.total = 0
+        self.samples = []
+        self._lock = Lock()
+        self._stopped = Event()
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+
+    def add(self, count):
+        with self._lock:
+            self.total += count
+
+    def start(self):
+        self.start_time = time()
+        self._thread.start()
+        return self.start_time
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        self.samples.append((time() - self.start_time, self.total))
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.samples.append((time() - self.start_time, self.total))
+
+
+def transferworker(pipe, barrier, host, kind, runs, duration, skip_warmup,
+                   engine):
+    """Process entry point for SpeedTest.processtransfer. Sends back
+    (speed, samples, timings), or the exception that stopped it."""
+    try:
+        speedtest = SpeedTest(host, runs=runs, duration=duration,
+                              skip_warmup=skip_warmup, engine=engine)
+        barrier.wait(PROCESS_START_TIMEOUT)
+        if kind == 'download':
+            speed = speedtest.rundownload(runs)
+        else:
+            speed = speedtest.runupload(runs)
+        pipe.send((speed, speedtest.samples.get(kind),
+                   speedtest.timings.get(kind)))
+    except Exception as e:
+        pipe.send(Exception('%s: %s' % (type(e).__name__, e)))
+    finally:
+        pipe.close()
+
+
+def mergesamples(curves):
+    """Add up (seconds, total bytes) samples taken in step by several
+    samplers."""
+    curves = [curve for curve in curves if curve]
+    merged = []
+    for i in range(max(len(curve) for curve in curves) if curves else 0):
+        points = [curve[min(i, len(curve) - 1)] for curve in curves]
+        merged.append((max(at for at, total in points),
+                       sum(total for at, total in points)))
+    return merged
+
+
+def samplerates(samples):
+    """Turn (seconds, total bytes) samples into (seconds, bits per second)
+    for each interval."""
+    rates = []
+    last_time, last_total = 0, 0
+    for at, total in samples or []:
+        if at > last_time:
+            rates.append((at, (total - last_total) * 8 / (at - last_time)))
+        last_time, last_total = at, total
+    return rates
+
+
+def percentile(values, fraction):
+    """Return the value at fraction (0 to 1) of the sorted values."""
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def confidence_interval(values):
+    """Return the mean of values and the half-width of its 95% confidence
+    interval from Student's t distribution, or None for the half-width if
+    there are fewer than 2 values."""
+    count = len(values)
+    mean = sum(values) / float(count)
+    if count < 2:
+        return mean, None
+    variance = sum((value - mean) ** 2 for value in values) / (count - 1)
+    t = T_975[count - 2] if count - 1 <= len(T_975) else 1.96
+    return mean, t * sqrt(variance / count)
+
+
+def curvestats(samples):
+    """Summarise (seconds, total bytes) samples in bits per second.
+
+    The steady-state rate is measured from the first interval that reaches
+    STEADY_FRACTION of the 90th percentile rate, which leaves out TCP slow
+    start. Returns None if there are too few samples."""
+    rates = samplerates(samples)
+    if len(rates) < 3:
+        return None
+    values = [rate for at, rate in rates]
+    p90 = percentile(values, 0.9)
+    warm = 0
+    while values[warm] < p90 * STEADY_FRACTION:
+        warm += 1
+    warmup_s = rates[warm - 1][0] if warm else 0
+    last_time, last_total = samples[-1]
+    warm_total = 0
+    for at, total in samples:
+        if at <= warmup_s:
+            warm_total = total
+    return {
+        'peak': max(values),
+        'steady': (last_total - warm_total) * 8 / (last_time - warmup_s),
+        'p10': percentile(values, 0.1),
+        'p50': percentile(values, 0.5),
+        'p90': p90,
+        'warmup_s': warmup_s,
+    }
+
+
+RequestTiming = namedtuple(
+    'RequestTiming', 'host dns_ms connect_ms ttfb_ms transfer_ms size')
+RequestTiming.__doc__ = """Where the time went for one request, in ms.
+
+dns_ms and connect_ms are only set on the first request of a connection.
+ttfb_ms is the wait for response headers after the request was sent, and
+transfer_ms is the time spent moving the payload: reading the body of a
+download, or sending the body of an upload."""
+
+
+def opensocket(addresses, timeout=None):
+    """Connect to the first reachable address returned by getaddrinfo."""
+    error = socket.error('No addresses to connect to')
+    for family, socktype, proto, _, address in addresses:
+        sock = socket.socket(family, socktype, proto)
+        try:
+            if timeout is not None:
+                sock.settimeout(timeout)
+            sock.connect(address)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            return sock
+        except socket.error as e:
+            sock.close()
+            error = e
+    raise error
+
+
+def distance(lat1, lon1, lat2, lon2):
+    """Return the great-circle distance in km between two coordinates."""
+    lat1, lon1, lat2, lon2 = map(radians, (lat1, lon1, lat2, lon2))
+    a = (sin((lat2 - lat1) / 2) ** 2 +
+         cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * asin(sqrt(a))
+
+
+def iterservers(source):
+    """Yield (url, lat, lon) for each server in a speedtest-servers.php
+    document, parsing it as it is read."""
+    for _, element in ElementTree.iterparse(source):
+        if element.tag == 'server':
+            try:
+                yield (element.get('url'),
+                       float(element.get('lat')),
+                       float(element.get('lon')))
+            except (TypeError, ValueError):
+                pass
+            element.clear()
+
+
+def payload(length):
+    """Return the upload body for length alphanumeric characters.
+
+    This is the same body as urlencode({'content0': content(length)}), but
+    sliced out of a shared block that is only rebuilt when it has to grow."""
+    global _payload
+    needed = len(PAYLOAD_PREFIX) + length
+    block = _payload
+    if len(block) < needed:
+        alphabet = SpeedTest.ALPHABET.encode('ascii')
+        block = PAYLOAD_PREFIX + alphabet * (length // len(alphabet) + 1)
+        _payload = block
+    return memoryview(block)[:needed]
 
 
 def content(length):
@@ -323,6 +1064,38 @@ def parseargs(args):
         help='use N runs (default is 2)',
         metavar='N',
         type=positive_int)
+    parser.add_argument(
+        '-a', '--max-runs',
+        default=None,
+        dest='max_runs',
+        help='keep doubling the number of runs, up to N, while the speed '
+             'still improves',
+        metavar='N',
+        type=positive_int)
+    parser.add_argument(
+        '-w', '--skip-warmup',
+        action='store_true',
+        dest='skip_warmup',
+        help='report the steady-state speed, leaving out TCP slow start')
+    parser.add_argument(
+        '-e', '--engine',
+        choices=('thread', 'asyncio'),
+        default='thread',
+        help='run connections on threads (default) or with asyncio')
+    parser.add_argument(
+        '-p', '--processes',
+        default=1,
+        help='spread the runs over N processes (default is 1)',
+        metavar='N',
+        type=positive_int)
+    parser.add_argument(
+        '-t', '--time',
+        default=None,
+        dest='duration',
+        help='keep transferring for S seconds, growing the payload size, '
+             'and report the steady-state speed (default is fixed sizes)',
+        metavar='S',
+        type=positive_int)
     parser.add_argument(
         '-s', '--server',
         help='use specific server',
@@ -347,7 +1120,9 @@ def parseargs(args):
 
 
 def perform_speedtest(opts):
-    speedtest = SpeedTest(opts.server, opts.debug, opts.runs)
+    speedtest = SpeedTest(opts.server, opts.debug, opts.runs, opts.duration,
+                          opts.max_runs, opts.skip_warmup, opts.engine,
+                          max(1, opts.processes))
 
     if opts.format in __supported_formats__:
 
@@ -360,9 +1135,13 @@ def perform_speedtest(opts):
 
             if opts.mode & 1 == 1:
                 print('Download speed: %s' % pretty_speed(speedtest.download()))
+                if opts.max_runs:
+                    print('Download runs: %d' % speedtest.used_runs['download'])
 
             if opts.mode & 2 == 2:
                 print('Upload speed: %s' % pretty_speed(speedtest.upload()))
+                if opts.max_runs:
+                    print('Upload runs: %d' % speedtest.used_runs['upload'])
 
         else:
             stats = dict(server=speedtest.host)
@@ -372,6 +1151,9 @@ def perform_speedtest(opts):
                 stats['download'] = speedtest.download()
             if opts.mode & 2 == 2:
                 stats['upload'] = speedtest.upload()
+            if opts.max_runs:
+                for key, val in speedtest.used_runs.items():
+                    stats[key + '_runs'] = val
             if opts.format == 'json':
                 from json import dumps
                 print(dumps(stats))
@@ -415,6 +1197,22 @@ def randint():
     return random.randint(100000000000, 999999999999)
 
 
+EARTH_RADIUS_KM = 6371.0
+
+STEADY_FRACTION = 0.8
+
+# Two-sided 95% critical values of Student's t for 1 to 30 degrees of freedom
+T_975 = (12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+         2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+         2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042)
+
+# Seconds worker processes wait for each other before transferring
+PROCESS_START_TIMEOUT = 30
+
+PAYLOAD_PREFIX = b'content0='
+
+_payload = b''
+
 LOG = logging.getLogger(__program__)
 
 if __name__ == '__main__':
@@ -0,0 +1,154 @@
+"""Hourly and daily aggregates of the test results for testinternet.py, so that long-term reports don't read every raw
+result, and so that old raw results can be deleted without losing the history"""
+
+import calendar
+import datetime
+import time
+
+from pyspeedtest import percentile
+from models import PhaseTiming, Rollup, TestResult, iter_rows
+
+periods = ('hour', 'day')
+metrics = ('ping', 'download', 'upload')
+
+# Name of the watermark recording the last result included in the rollups
+watermark_name = 'rollups'
+
+
+def period_start(timestamp, period, useutc=False):
+    """Timestamp of the start of the hour or day that timestamp falls in, in UTC or local time"""
+    dt = datetime.datetime.utcfromtimestamp(timestamp) if useutc else datetime.datetime.fromtimestamp(timestamp)
+    dt = dt.replace(minute=0, second=0, microsecond=0)
+    if period == 'day':
+        dt = dt.replace(hour=0)
+    return calendar.timegm(dt.timetuple()) if useutc else time.mktime(dt.timetuple())
+
+
+def period_end(start, period, useutc=False):
+    # Going through the calendar rather than adding seconds keeps days right across DST changes
+    dt = datetime.datetime.utcfromtimestamp(start) if useutc else datetime.datetime.fromtimestamp(start)
+    dt += datetime.timedelta(hours=1) if period == 'hour' else datetime.timedelta(days=1)
+    return calendar.timegm(dt.timetuple()) if useutc else time.mktime(dt.timetuple())
+
+
+def measured(values):
+    """Leaves out missing values and the zeros stored by failed tests, like testinternet.measured_values"""
+    return [v for v in values if isinstance(v, (int, float)) and v > 0]
+
+
+def set_stats(rollup, metric, values):
+    """Sets the metric_* columns of rollup from the metric's values, leaving out missing and failed ones"""
+    values = measured(values)
+    setattr(rollup, metric + '_count', len(values))
+    if not values:
+        for stat in ('min', 'max', 'mean', 'p50', 'p95'):
+            setattr(rollup, '{}_{}'.format(metric, stat), None)
+        return
+    setattr(rollup, metric + '_min', min(values))
+    setattr(rollup, metric + '_max', max(values))
+    setattr(rollup, metric + '_mean', sum(values) / len(values))
+    setattr(rollup, metric + '_p50', percentile(values, 0.5))
+    setattr(rollup, metric + '_p95', percentile(values, 0.95))
+
+
+def merge_stats(rollup, metric, values):
+    """Adds values to a compacted rollup. Count, min, max and mean stay exact, the percentiles become count-weighted estimates"""
+    values = measured(values)
+    old = getattr(rollup, metric + '_count') or 0
+    if not old or not values:
+        if values:
+            set_stats(rollup, metric, values)
+        return
+    added = Rollup()
+    set_stats(added, metric, values)
+    stat = lambda r, name: getattr(r, '{}_{}'.format(metric, name))
+    total = old + len(values)
+    setattr(rollup, metric + '_count', total)
+    setattr(rollup, metric + '_min', min(stat(rollup, 'min'), stat(added, 'min')))
+    setattr(rollup, metric + '_max', max(stat(rollup, 'max'), stat(added, 'max')))
+    for name in ('mean', 'p50', 'p95'):
+        setattr(rollup, '{}_{}'.format(metric, name), (stat(rollup, name) * old + stat(added, name) * len(values)) / total)
+
+
+def fill(rollup, rows, after):
+    """Sets rollup from all the raw rows in its period. A compacted rollup, whose raw results are gone, has just the rows
+    with ids above after merged in"""
+    if rollup.compacted:
+        rows = [row for row in rows if row.id > after]
+        rollup.count += len(rows)
+        for metric in metrics:
+            merge_stats(rollup, metric, [getattr(row, metric) for row in rows])
+        return
+    rollup.count = len(rows)
+    for metric in metrics:
+        set_stats(rollup, metric, [getattr(row, metric) for row in rows])
+
+
+def update_rollups(sess, useutc=False):
+    """Brings the rollups up to date with the results recorded since the last update, recalculating only the hours and
+    days those fall in, a day's results at a time. Each target gets its own rollups. Returns how many results were new"""
+    from models import Watermark
+    mark = sess.query(Watermark).filter(Watermark.sink == watermark_name).first()
+    if mark is None:
+        mark = Watermark(sink=watermark_name, last_id=0)
+        sess.add(mark)
+    after = mark.last_id
+    touched = {} # day start: set of hour starts
+    new = 0
+    for row in iter_rows(sess, after=after):
+        touched.setdefault(period_start(row.date, 'day', useutc), set()).add(period_start(row.date, 'hour', useutc))
+        mark.last_id = row.id
+        new += 1
+    if touched:
+        first, last = min(touched), period_end(max(touched), 'day', useutc)
+        existing = dict(((r.period, r.start, r.target), r) for r in sess.query(Rollup).filter(Rollup.start >= first, Rollup.start < last))
+        for day in sorted(touched):
+            rows = sess.query(TestResult.id, TestResult.date, TestResult.ping, TestResult.download, TestResult.upload, TestResult.target).filter(TestResult.date >= day, TestResult.date < period_end(day, 'day', useutc)).all()
+            by_target = {}
+            for row in rows:
+                by_target.setdefault(row.target, []).append(row)
+            for target, target_rows in by_target.items():
+                by_hour = {}
+                for row in target_rows:
+                    by_hour.setdefault(period_start(row.date, 'hour', useutc), []).append(row)
+                for period, start, period_rows in [('day', day, target_rows)] + [('hour', hour, by_hour[hour]) for hour in sorted(touched[day]) if hour in by_hour]:
+                    rollup = existing.get((period, start, target))
+                    if rollup is None:
+                        rollup = Rollup(period=period, start=start, target=target, count=0, compacted=False)
+                        sess.add(rollup)
+                    fill(rollup, period_rows, after)
+    mark.date = time.time()
+    sess.commit()
+    return new
+
+
+def compact(sess, raw_days=None, hourly_days=None, useutc=False):
+    """Deletes raw results older than raw_days and hourly rollups older than hourly_days (None keeps them). Raw results are
+    only deleted a whole day at a time, from days where every result has been rolled up and marked sent, so nothing is
+    deleted before it has been delivered. Daily rollups are kept. Returns how many raw results were deleted"""
+    from models import OutboxBatch, Watermark
+    deleted = 0
+    if raw_days is not None:
+        mark = sess.query(Watermark).filter(Watermark.sink == watermark_name).first()
+        rolled_up = mark.last_id if mark is not None else 0
+        waiting = (TestResult.id > rolled_up) | (TestResult.sent == False)
+        cutoff = period_start(time.time() - raw_days * 24 * 60 * 60, 'day', useutc)
+        # Stop at the first day that still has a result waiting for a rollup or delivery
+        waiting = sess.query(TestResult.date).filter(TestResult.date < cutoff, waiting).order_by(TestResult.date).first()
+        if waiting is not None:
+            cutoff = period_start(waiting.date, 'day', useutc)
+        old = sess.query(TestResult.id).filter(TestResult.date < cutoff).scalar_subquery()
+        sess.query(PhaseTiming).filter(PhaseTiming.testresult_id.in_(old)).delete(synchronize_session=False)
+        deleted = sess.query(TestResult).filter(TestResult.date < cutoff).delete(synchronize_session=False)
+        sess.query(Rollup).filter(Rollup.start < cutoff, Rollup.compacted == False).update({Rollup.compacted: True}, synchronize_session=False)
+        sess.query(OutboxBatch).filter(OutboxBatch.sent < cutoff).delete(synchronize_session=False)
+    if hourly_days is not None:
+        sess.query(Rollup).filter(Rollup.period == 'hour', Rollup.start < time.time() - hourly_days * 24 * 60 * 60).delete(synchronize_session=False)
+    sess.commit()
+    sess.expire_all()
+    return deleted
+
+
+def rollups(sess, period, since):
+    """The rollups of period starting at or after since, oldest first, for every target"""
+    return sess.query(Rollup).filter(Rollup.period == period, Rollup.start >= since).order_by(Rollup.start, Rollup.target).all()
@@ -0,0 +1,146 @@
+"""Runs jobs on interval ("30s", "5m", "1h", "1d") or cron ("*/5 * * * *") schedules, for testinternet.py --daemon"""
+
+import datetime
+import random
+import re
+import threading
+import time
+
+intervalreg = re.compile(r'^(\d+(?:\.\d+)?)\s*([smhd]?)$')
+interval_units = {'': 1, 's': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60}
+
+
+class IntervalSchedule(object):
+    def __init__(self, seconds):
+        if seconds <= 0:
+            raise ValueError('Interval must be positive')
+        self.seconds = seconds
+
+    def next_after(self, t):
+        return t + self.seconds
+
+    def __repr__(self):
+        return 'every {}s'.format(self.seconds)
+
+
+def parse_cron_field(field, low, high):
+    """Returns the set of values matched by one cron field, e.g. '*', '*/15', '1-5', '0,30'"""
+    values = set()
+    for part in field.split(','):
+        rng, _, step = part.partition('/')
+        step = int(step) if step else 1
+        if rng == '*':
+            start, end = low, high
+        elif '-' in rng:
+            start, end = [int(x) for x in rng.split('-')]
+        else:
+            start = end = int(rng)
+            if step != 1:
+                end = high
+        if start < low or end > high or start > end or step < 1:
+            raise ValueError('Bad cron field {}'.format(field))
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class CronSchedule(object):
+    """Standard five field cron spec: minute hour day-of-month month day-of-week (0 or 7 is Sunday), in local time"""
+
+    def __init__(self, spec):
+        fields = spec.split()
+        if len(fields) != 5:
+            raise ValueError('Cron spec needs 5 fields: {}'.format(spec))
+        self.spec = spec
+        self.minutes = parse_cron_field(fields[0], 0, 59)
+        self.hours = parse_cron_field(fields[1], 0, 23)
+        self.days = parse_cron_field(fields[2], 1, 31)
+        self.months = parse_cron_field(fields[3], 1, 12)
+        self.weekdays = set(d % 7 for d in parse_cron_field(fields[4], 0, 7))
+        # Like cron, if both day fields are restricted a day matching either one counts
+        self.any_day = fields[2] != '*' and fields[4] != '*'
+
+    def day_matches(self, dt):
+        in_days = dt.day in self.days
+        in_weekdays = (dt.weekday() + 1) % 7 in self.weekdays
+        if self.any_day:
+            return in_days or in_weekdays
+        return in_days and in_weekdays
+
+    def next_after(self, t):
+        dt = datetime.datetime.fromtimestamp(t).replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        end = dt + datetime.timedelta(days=366 * 4)
+        while dt < end:
+            if dt.month not in self.months or not self.day_matches(dt):
+                dt = (dt + datetime.timedelta(days=1)).replace(hour=0, minute=0)
+            elif dt.hour not in self.hours:
+                dt = (dt + datetime.timedelta(hours=1)).replace(minute=0)
+            elif dt.minute not in self.minutes:
+                dt += datetime.timedelta(minutes=1)
+            else:
+                return time.mktime(dt.timetuple())
+        raise ValueError('Cron spec never matches: {}'.format(self.spec))
+
+    def __repr__(self):
+        return 'cron "{}"'.format(self.spec)
+
+
+def parse_schedule(spec):
+    """'300', '30s', '5m', '1h' or '1d' give an IntervalSchedule, anything else is read as a cron spec"""
+    match = intervalreg.match(spec.strip())
+    if match:
+        return IntervalSchedule(float(match.group(1)) * interval_units[match.group(2)])
+    return CronSchedule(spec)
+
+
+class Job(object):
+    def __init__(self, name, schedule, func, jitter):
+        self.name = name
+        self.schedule = schedule
+        self.func = func
+        self.jitter = jitter
+        self.due = None
+
+    def plan(self, after):
+        self.due = self.schedule.next_after(after) + random.uniform(0, self.jitter)
+
+
+class Scheduler(object):
+    """Runs jobs one at a time on a single thread, so that tests never compete with each other for the link or the database"""
+
+    def __init__(self):
+        self.jobs = []
+        self._stopped = threading.Event()
+
+    def add(self, name, schedule, func, jitter=0):
+        """jitter adds up to that many random seconds to each run, so that devices on the same schedule spread out"""
+        job = Job(name, schedule, func, jitter)
+        self.jobs.append(job)
+        return job
+
+    def stop(self):
+        self._stopped.set()
+
+    @property
+    def stopped(self):
+        return self._stopped.is_set()
+
+    def run(self, run_first=True):
+        """Runs until stop() is called. If run_first, interval jobs run once (after their jitter) at startup. Cron jobs
+        always wait for their next match"""
+        now = time.time()
+        for job in self.jobs:
+            if run_first and isinstance(job.schedule, IntervalSchedule):
+                job.due = now + random.uniform(0, job.jitter)
+            else:
+                job.plan(now)
+        while self.jobs and not self.stopped:
+            job = min(self.jobs, key=lambda j: j.due)
+            if self._stopped.wait(max(0, job.due - time.time())):
+                break
+            print("Running {} at {}".format(job.name, datetime.datetime.now()))
+            try:
+                job.func()
+            except Exception as e:
+                print("{} failed".format(job.name))
+                print(e)
+            job.plan(time.time())
@@ -0,0 +1,105 @@
+"""Appends new results to a rolling per-device file over one long-lived SFTP session, for frequent deliveries from testinternet.py --daemon"""
+
+import datetime
+import posixpath
+import time
+
+import export
+from models import batch_rows
+
+
+class SFTPSink(object):
+    """An outbox sink that keeps one SSH connection open between deliveries, and appends each batch to the day's file in
+    one transfer. Retries after failures are left to the outbox"""
+
+    # Seconds between SSH keepalives, so that idle connections aren't dropped by NAT
+    KEEPALIVE = 30
+    # Bytes per SFTP write
+    WRITE_CHUNK = 32 * 1024
+
+    def __init__(self, host, username, password, directory, devicename, fmt='csv', useutc=False, name='sftp'):
+        if export.split_format(fmt)[0] != 'csv':
+            raise ValueError('Only csv formats can be appended to, not {}'.format(fmt))
+        self.host = host
+        self.username = username
+        self.password = password
+        self.directory = directory
+        self.devicename = devicename
+        self.fmt = fmt
+        self.useutc = useutc
+        self.name = name
+        self.client = None
+        self.sftp = None
+
+    def connected(self):
+        transport = self.client.get_transport() if self.client is not None else None
+        return self.sftp is not None and transport is not None and transport.is_active()
+
+    def connect(self):
+        from paramiko import SSHClient
+        from paramiko.client import AutoAddPolicy
+        self.close()
+        client = SSHClient()
+        client.load_system_host_keys()
+        client.set_missing_host_key_policy(AutoAddPolicy)
+        client.connect(self.host, username=self.username, password=self.password)
+        client.get_transport().set_keepalive(self.KEEPALIVE)
+        self.client = client
+        self.sftp = client.open_sftp()
+
+    def close(self):
+        if self.client is not None:
+            self.client.close()
+        self.client = None
+        self.sftp = None
+
+    def remote_path(self, now):
+        """One file per device per day"""
+        day = datetime.datetime.utcfromtimestamp(now) if self.useutc else datetime.datetime.fromtimestamp(now)
+        return posixpath.join(self.directory, '{devicename}_{day}.{ext}'.format(devicename=self.devicename, day=day.strftime('%Y-%m-%d'), ext=self.fmt))
+
+    def remote_size(self, path):
+        try:
+            return self.sftp.stat(path).st_size
+        except FileNotFoundError:
+            return 0
+
+    def send(self, sess, batch):
+        """Appends batch (a models.OutboxBatch)"""
+        if not self.connected():
+            self.connect()
+            return self.append(sess, batch)
+        try:
+            return self.append(sess, batch)
+        except Exception as e:
+            # The kept-open connection may have been dropped without us noticing, so try once more on a new one
+            print("SFTP connection failed, reconnecting: {}".format(e))
+            try:
+                self.connect()
+            except Exception:
+                self.close()
+                raise
+            return self.append(sess, batch)
+
+    def append(self, sess, batch):
+        """The file and its size are stored with the batch before anything is written, so a retry goes to the same file
+        (even on a later day) and first cuts off whatever an earlier attempt managed to write"""
+        if batch.remote_path is None:
+            batch.remote_path = self.remote_path(time.time())
+            batch.remote_size = self.remote_size(batch.remote_path)
+            sess.commit()
+        path = batch.remote_path
+        size = self.remote_size(path)
+        if size > batch.remote_size:
+            self.sftp.truncate(path, batch.remote_size)
+            size = batch.remote_size
+        with export.spool() as spooled:
+            export.write_export(batch_rows(sess, batch), spooled, self.fmt, self.devicename, self.useutc, header=size == 0)
+            spooled.seek(0)
+            with self.sftp.open(path, 'ab') as remote:
+                remote.set_pipelined(True)
+                while True:
+                    chunk = spooled.read(self.WRITE_CHUNK)
+                    if not chunk:
+                        break
+                    remote.write(chunk)
@@ -1,11 +1,7 @@
 #!./env/bin/python3
 
-import smtplib
 import pyspeedtest
-from sqlalchemy import create_engine, Column, ForeignKey, Integer, String, Float, Boolean
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, sessionmaker
-from sqlalchemy.sql import null
+import fastdb
 import time
 import datetime
 import os
@@ -16,27 +12,51 @@ import sys
 import subprocess
 import re
 import contextlib
-from urllib.request import urlopen
-from io import StringIO
+import multiprocessing
+import signal
+import threading
+import scheduler
+from io import BytesIO
 
-from email.mime.image import MIMEImage
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from email.mime.base import MIMEBase
-from email import encoders
-
-from paramiko import SSHClient
-from paramiko.client import AutoAddPolicy
-from scp import SCPClient
+# The database layer (models, SQLAlchemy) and the email/SCP delivery modules are
+# imported where they are used, so that a plain test run starts quickly.
 
 to_email = "" # Email that the message will be sent to. Set via the -e/--email command line arg
 times_to_take_test = 5 # Number of times that the test will be run. Set via the -i/--iterations command line arg
+converge_percent = None # If set, stop testing once the 95% confidence interval of the mean ping, download and upload is within this percent of the mean, running at most times_to_take_test times. Set via -cv/--converge
+converge_max_time = None # Seconds a -cv/--converge run may take. It stops before an iteration that would go over. Set via -mt/--maxtime
+converge_min_iterations = 3 # Iterations that a -cv/--converge run always takes, so that a couple of results that agree by chance don't end it
 devicename = "nohostnamedetected" # Name of the device that will be reported on the test. Default is the hostname of the machine. Set via the -n/--name command line arg
 useutc = False # If true, uses utc time when sending the email. If false, uses the timezone of the server. set via -u/--utc
 pingtest = False
 uptest = ''
+probe_mode = 'tcp' # How -up/--unixping measures latency: 'tcp' connects, 'udp' echo requests, or 'system' to run the ping command. Set via -pm/--probemode
+probe_count = 10 # Probes sent per latency test. Set via -pc/--probecount
+probe_interval = 0.2 # Seconds between latency probes. Set via -pi/--probeinterval
 scp_host = ""
 scp_dir = ""
+test_duration = None # Seconds each download/upload keeps transferring, growing the payload size. None uses the fixed file sizes. Set via -du/--duration
+max_streams = None # If set, parallel connections are doubled up to this many while the speed keeps improving. Set via -ms/--maxstreams
+skip_warmup = False # If true, download/upload are the steady-state speed, leaving out TCP slow start. Set via -sw/--skipwarmup
+test_engine = 'thread' # How SpeedTest runs its connections, 'thread' or 'asyncio'. Set via -en/--engine
+test_processes = 1 # Worker processes to spread download/upload connections over. Set via -pr/--processes
+cold_connections = False # If true, every test opens new connections instead of reusing them. Set via -cc/--coldconnections
+record_phases = False # If true, stores DNS/connect/first byte/transfer times for every stream of every test. Set via -pt/--phasetimes
+export_format = 'csv' # Format of the results sent by email/SCP: csv or col (columnar), optionally compressed as csv.gz, csv.zst, col.gz, col.zst. Set via -xf/--exportformat
+sftp_append = False # If true, -s/--scphost deliveries append new results to a daily file per device over one SFTP connection that is kept open. Set via -sf/--sftp
+sftp_batch = 1 # Results that must be waiting before an -sf/--sftp delivery sends them. Set via -sb/--sftpbatch
+sftp_max_wait = 60 * 60 # Seconds after which waiting results are sent by -sf/--sftp even if there are fewer than sftp_batch. Set via -sm/--sftpmaxwait
+sftp_sink = None # The sftpsink.SFTPSink, made on first use
+outbox = None # The outbox.Outbox, made on first use
+ip_cache_ttl = 60 * 60 # Seconds that the public and internal IP are reused before being looked up again. Set via -it/--ipttl
+network_identity = None # The netidentity.NetworkIdentity, made on first use
+raw_retention_days = None # Days of raw results to keep. Older ones are deleted once they are in the hourly/daily rollups and delivered. None keeps them all. Set via -rr/--rawretention
+hourly_retention_days = None # Days of hourly rollups to keep. Daily rollups are always kept. Set via -hr/--hourlyretention
+test_targets = [] # Speedtest servers (host:port) to test on every iteration instead of the chosen one, each result tagged with its target. Set via -tg/--targets
+target_mode = 'staggered' # How several targets share the link: 'staggered' gives each target's download/upload the link to itself in turn, 'together' tests all of them at once. Set via -tm/--targetmode
+metrics_port = None # Port to serve live Prometheus metrics on, from memory. Set via -mp/--metricsport
+live_metrics = None # The metrics.Metrics, made when metrics_port is set
+server_cache_ttl = 24 * 60 * 60 # Seconds that a chosen speedtest server is reused before selecting again. Set via -st/--serverttl
 
 try:
     devicename = socket.gethostname()
@@ -54,45 +74,152 @@ def get_gmail_creds():
 def get_ssh_creds():
     return get_creds('SSH')
 
-Base = declarative_base()
-class TestResult(Base):
-    __tablename__ = 'testresults'
-    id = Column(Integer, primary_key=True)
-    date = Column(Float)
-    ping = Column(Float, default=0)
-    upload = Column(Float, default=0)
-    download = Column(Float, default=0)
-    sent = Column(Boolean, default=False)
+def encode_samples(st, kind):
+    """Compact form of a sampled throughput curve: the sample interval in ms, a colon, then the kbps of each interval"""
+    rates = st.curve(kind)
+    if not rates:
+        return None
+    return '{interval}:{rates}'.format(interval=int(st.SAMPLE_INTERVAL * 1000), rates=','.join(str(int(rate / 1000)) for at, rate in rates))
+
+def add_phase_timings(record, st, kind):
+    for stream in st.streamtimings(kind):
+        record.add_phase(kind=kind, **stream)
+
+def new_result(sess, **kwargs):
+    if isinstance(sess, fastdb.FastSession):
+        return fastdb.Result(**kwargs)
+    from models import TestResult
+    return TestResult(**kwargs)
+
+def server_choice_is_fresh(choice, location):
+    """True if the cached choice is within its TTL and was made from the same IP and coordinates"""
+    if choice is None or not choice.host:
+        return False
+    if time.time() - choice.date > server_cache_ttl:
+        return False
+    if location is None: # Can't tell if we moved, and couldn't select a new server anyway
+        return True
+    ip, lat, lon = location
+    return ip == choice.ip and abs(float(lat) - choice.lat) < 0.0001 and abs(float(lon) - choice.lon) < 0.0001
+
+def choose_server(sess):
+    """Returns the cached ServerChoice, running server selection only if the cache is stale"""
+    if isinstance(sess, fastdb.FastSession):
+        # Go by the TTL alone, and only load the ORM if the cache has to be refreshed
+        choice = sess.cached_choice()
+        if choice is not None and choice.host and time.time() - choice.date <= server_cache_ttl:
+            return choice
+        # Copy the new choice out of the ORM session, which is closed before it is used
+        orm_sess = init_db()
+        try:
+            choice = choose_server(orm_sess)
+            return fastdb.Choice(id=choice.id, date=choice.date, host=choice.host, candidates=choice.candidates, ip=choice.ip, lat=choice.lat, lon=choice.lon)
+        finally:
+            orm_sess.close()
+    from models import ServerChoice
+    st = pyspeedtest.SpeedTest()
+    location = None
+    try:
+        location = st.clientinfo()
+    except Exception as e:
+        print('Could not look up client location')
+        print(e)
+    if location is not None:
+        get_identity(sess).observe('public', location[0], 'speedtest')
+    choice = sess.query(ServerChoice).order_by(ServerChoice.date.desc()).first()
+    if server_choice_is_fresh(choice, location):
+        return choice
+    print("Choosing a speedtest server")
+    ranked = st.rankservers(location)
+    if not ranked:
+        raise Exception('Cannot find a test server')
+    sess.query(ServerChoice).delete()
+    choice = ServerChoice(date=time.time(), host=ranked[0], candidates=','.join(ranked), ip=location[0], lat=float(location[1]), lon=float(location[2]))
+    sess.add(choice)
+    sess.commit()
+    return choice
+
+def save_choice(sess, choice):
+    if isinstance(sess, fastdb.FastSession):
+        sess.save_choice(choice)
+    else:
+        sess.commit()
 
-    def __repr__(self):
-        return '{{"date":{date},"ping":{ping},"upload":{upload},"download":{download}}}'.format(date=self.date, ping=self.ping, upload=self.upload, download=self.download)
+def with_failover(sess, choice, st, measure):
+    """Calls measure(st), moving st (and the cache) to the next candidate server when the current one fails. Failed
+    servers are dropped from the cached candidates, and once none are left the cache is expired so the next run chooses again"""
+    tried = set()
+    while True:
+        try:
+            return measure(st)
+        except Exception:
+            if choice is None:
+                raise
+            tried.add(choice.host)
+            remaining = []
+            for host in choice.candidate_list():
+                if host not in tried and host not in remaining:
+                    remaining.append(host)
+            choice.candidates = ','.join(remaining)
+            if not remaining:
+                print("Server {} failed, and no other servers are left to try".format(choice.host))
+                choice.date = 0
+                save_choice(sess, choice)
+                raise
+            print("Server {} failed, trying {}".format(choice.host, remaining[0]))
+            choice.host = remaining[0]
+            st.host = choice.host
+            save_choice(sess, choice)
 
 def make_mbps(bps):
     return round(bps / 1000000, 2)
 
-def record_speed_test(sess):
+def observe_test(record, kind, seconds, failed_stage=None, choice=None):
+    """Updates the live metrics, if they are being served, with a finished test"""
+    if live_metrics is None:
+        return
+    if choice is not None:
+        live_metrics.set_server(choice.host)
+    live_metrics.record(record, kind, seconds, failed_stage)
+
+def set_speed(record, st, kind, bps):
+    """Sets the download or upload speed of record, with the streams and samples st used"""
+    setattr(record, kind, make_mbps(bps))
+    setattr(record, kind + '_streams', st.used_runs.get(kind))
+    setattr(record, kind + '_samples', encode_samples(st, kind))
+
+def record_speed_test(sess, choice=None, pool=None, ping_only=None):
+    if ping_only is None:
+        ping_only = pingtest
+    started = time.time()
+    stage = 'setup'
+    failed_stage = None
     try:
         record = None
-        st = pyspeedtest.SpeedTest()
-        record = TestResult(date=time.time())
+        st = pyspeedtest.SpeedTest(choice.host if choice else None, duration=test_duration, max_runs=max_streams, skip_warmup=skip_warmup, engine=test_engine, processes=test_processes, pool=pool)
+        record = new_result(sess, date=time.time())
+        stage = 'ping'
         # Adding results seperately, so that if any errors occur we still have results for the previous steps.
         if uptest:
-            ping_response = subprocess.Popen(["ping", "-c 1", "-W 100", uptest], stdout=subprocess.PIPE).stdout.read()
-            timeres_str = upingreg.findall(ping_response.decode('UTF-8'))[0].replace('time=', '')
-            timeres = float(timeres_str)
-            record.ping = timeres
+            record_latency(record)
         else:
-            record.ping = round(st.ping(), 2)
-        if (pingtest):
-            record.download = null()
-            record.upload = null()
+            record.ping = round(with_failover(sess, choice, st, lambda s: s.ping()), 2)
+        if (ping_only):
+            record.set_ping_only()
         else:
-            record.download = make_mbps(st.download())
-            record.upload = make_mbps(st.upload())
+            stage = 'download'
+            set_speed(record, st, 'download', with_failover(sess, choice, st, lambda s: s.download()))
+            stage = 'upload'
+            set_speed(record, st, 'upload', with_failover(sess, choice, st, lambda s: s.upload()))
     except:
+        failed_stage = stage
         print("Speed Test didn't complete")
     finally:
+        if record_phases and record is not None:
+            for kind in ('ping', 'download', 'upload'):
+                add_phase_timings(record, st, kind)
         sess.add(record)
+        observe_test(record, 'ping' if ping_only else 'speed', time.time() - started, failed_stage, choice)
         # sess.commit()
         return record
 
@@ -100,15 +227,34 @@ upingreg_raw = r'time=[0-9\.]*'
 upingreg = re.compile(upingreg_raw)
 
 
+def system_ping(target=None):
+    ping_response = subprocess.Popen(["ping", "-c 1", "-W 100", target or uptest], stdout=subprocess.PIPE).stdout.read()
+    timeres_str = upingreg.findall(ping_response.decode('UTF-8'))[0].replace('time=', '')
+    return float(timeres_str)
+
+def record_latency(record, target=None):
+    """Measures latency to target (default uptest), filling in the ping stats of record"""
+    target = target or uptest
+    if probe_mode == 'system':
+        record.ping = system_ping(target)
+        return
+    host, _, port = target.partition(':')
+    probe = pyspeedtest.LatencyProbe(host, int(port) if port else None, probe_mode, probe_count, probe_interval)
+    stats = probe.burst()
+    if stats['avg'] is None:
+        record.set_ping_lost()
+    else:
+        record.ping = round(stats['avg'], 2)
+    record.ping_min = stats['min']
+    record.ping_p95 = stats['p95']
+    record.jitter = stats['jitter']
+    record.loss = stats['loss']
+
 def do_unix_ping_test(sess):
     try:
         record = None
-        record = TestResult(date=time.time())
-        # Adding results seperately, so that if any errors occur we still have results for the previous steps.
-        ping_response = subprocess.Popen(["ping", "-c 1", "-W 100", uptest], stdout=subprocess.PIPE).stdout.read()
-        timeres_str = upingreg.findall(ping_response.decode('UTF-8'))[0].replace('time=', '')
-        timeres = float(timeres_str)
-        record.ping = timeres
+        record = new_result(sess, date=time.time())
+        record_latency(record)
     except Exception as e:
         print("Speed Test didn't complete")
     finally:
@@ -117,57 +263,104 @@ def do_unix_ping_test(sess):
         return record
 
 
-COMMASPACE = ', '
-
-
-def send_an_email(subject, body, attachment_string=None):
+def target_list(choice=None, ping_only=False):
+    """(kind, host) of every target to test on each iteration, kind being 'speedtest' or 'probe'. Empty unless
+    -tg/--targets or several -up/--unixping targets are given. The chosen server (choice) is only a target without -tg/--targets"""
+    probes = [t.strip() for t in (uptest or '').split(',') if t.strip()]
+    if not test_targets and len(probes) < 2:
+        return []
+    servers = test_targets or ([choice.host] if choice is not None and not ping_only else [])
+    return [('speedtest', host) for host in servers] + [('probe', host) for host in probes]
+
+def target_tag(kind, host):
+    """TestResult.target of a target, which keeps a probe and a speedtest server on the same host apart"""
+    return '{}:{}'.format('probe' if kind == 'probe' else 'server', host)
+
+class TargetTest(object):
+    """The result of one target in a multi-target iteration, measured a stage (ping, download, upload) at a time"""
+
+    def __init__(self, sess, kind, host, ping_only, pool):
+        self.kind = kind
+        self.host = host
+        self.record = new_result(sess, date=time.time(), target=target_tag(kind, host))
+        if kind == 'probe' or ping_only:
+            self.record.set_ping_only()
+        self.st = pyspeedtest.SpeedTest(host, duration=test_duration, max_runs=max_streams, skip_warmup=skip_warmup, engine=test_engine, processes=test_processes, pool=pool) if kind == 'speedtest' else None
+        self.failed_stage = None
+        self.seconds = 0
+
+    def run(self, stage):
+        if self.failed_stage or (stage != 'ping' and self.st is None):
+            return
+        started = time.time()
+        try:
+            if self.st is None:
+                record_latency(self.record, self.host)
+            elif stage == 'ping':
+                self.record.ping = round(self.st.ping(), 2)
+            else:
+                set_speed(self.record, self.st, stage, getattr(self.st, stage)())
+        except Exception as e:
+            self.failed_stage = stage
+            print("Test of {} didn't complete".format(self.host))
+            print(e)
+        finally:
+            self.seconds += time.time() - started
+
+def run_at_once(functions):
+    threads = [threading.Thread(target=f, name='target') for f in functions]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+def record_target_tests(sess, targets, pool=None, ping_only=None):
+    """Tests every target of target_list() once, storing a result tagged with each. In 'together' mode every target
+    runs its whole test at the same time. In 'staggered' mode the pings and latency probes, which barely load the link,
+    run at the same time, then each speedtest target gets the link to itself for its download and upload in turn"""
+    if ping_only is None:
+        ping_only = pingtest
+    tests = [TargetTest(sess, kind, host, ping_only, pool) for kind, host in targets]
+    stages = ['ping'] if ping_only else ['ping', 'download', 'upload']
+    if target_mode == 'together':
+        run_at_once([lambda t=t: [t.run(stage) for stage in stages] for t in tests])
+    else:
+        run_at_once([lambda t=t: t.run('ping') for t in tests])
+        for t in tests:
+            for stage in stages[1:]:
+                t.run(stage)
+    for t in tests:
+        if record_phases and t.st is not None:
+            for kind in stages:
+                add_phase_timings(t.record, t.st, kind)
+        sess.add(t.record)
+        observe_test(t.record, 'ping' if ping_only or t.st is None else 'speed', t.seconds, t.failed_stage)
+    return [t.record for t in tests]
+
+
+def send_an_email(subject, body, write_attachment=None, attachment_format='csv'):
+    """Sends body, with an attachment written by write_attachment(binary sink) in attachment_format. The message is built in a spool file and sent from there a line at a time"""
+    import smtplib
+    import export
     user, password = get_gmail_creds() # Do this first, so that we fail fast if this isn't set
-    msg = MIMEMultipart()
-    msg['Subject'] = subject
-    # me == the sender's email address
-    # family = the list of all recipients' email addresses
-    msg['From'] = user
-    msg['To'] = to_email
-
-    if attachment_string:
-        part = MIMEText(attachment_string, "csv")
-        # encoders.encode_base64(part)
-        part.add_header('Content-Disposition', 'attachment', filename='data_{subject}.csv'.format(subject=subject))
-        msg.attach(part)
-    
-    part = MIMEText(body)
-    msg.attach(part)
-
-    server = smtplib.SMTP_SSL('smtp.gmail.com', 465)
-    server.ehlo()
-    server.login(user, password)
-    print(msg.as_string())
-    server.sendmail(user, to_email, msg.as_string())
-    server.close()
+    attachments = []
+    if write_attachment is not None:
+        attachments.append(('data_{subject}.{ext}'.format(subject=subject, ext=attachment_format), export.content_type(attachment_format), write_attachment))
+
+    with export.spool() as msg:
+        export.write_email(msg, user, to_email, subject, body, attachments)
+        print("Sending {subject} ({size} bytes)".format(subject=subject, size=msg.tell()))
+        msg.seek(0)
+        server = smtplib.SMTP_SSL('smtp.gmail.com', 465)
+        server.ehlo()
+        server.login(user, password)
+        export.smtp_send_file(server, user, to_email, msg)
+        server.close()
     return True
 
 
-def format_results_for_email(q):
-    messagestring = """\
-| Time and Date | Ping (ms) | Download (mbps) | Upload (mbps) | Device |
-| ------------- | --------- | ------------- | --------------- | ------ |
-"""
-    for rec in q:
-        dt = ""
-        if (useutc):
-            dt = datetime.datetime.utcfromtimestamp(rec.date)
-        else:
-            dt = datetime.datetime.fromtimestamp(rec.date).strftime('%Y-%m-%d %H:%M:%S %z')
-        messagestring += "| {date} | {ping} | {download} | {upload} | {devicename} |\n".format(
-            date=dt,
-            ping=rec.ping,
-            download=rec.download,
-            upload=rec.upload,
-            devicename=devicename
-        )
-    return messagestring
-
 def get_public_ip():
+    from urllib.request import urlopen
     with urlopen('https://api.ipify.org') as r:
         ip = r.read()
         ip = ip.decode("utf-8") 
@@ -176,58 +369,46 @@ def get_public_ip():
 def get_internal_ip():
     return socket.gethostbyname(socket.gethostname())
 
-def make_email_body(q):
-    l = len(q)
-    pubip = get_public_ip()
-    prvip = get_internal_ip()
+def get_identity(sess=None):
+    """The netidentity.NetworkIdentity, made on first use. Changes are only recorded once it has been given an ORM session"""
+    global network_identity
+    if network_identity is None:
+        from netidentity import NetworkIdentity
+        network_identity = NetworkIdentity(get_public_ip, get_internal_ip, ttl=ip_cache_ttl)
+    if network_identity.session_factory is None and sess is not None and not isinstance(sess, fastdb.FastSession):
+        from models import session_factory
+        network_identity.session_factory = session_factory(sess)
+    return network_identity
+
+def make_email_body():
+    identity = get_identity()
+    pubip = identity.public_ip()
+    prvip = identity.internal_ip()
     emailbody = """Results from {machinename}. Public IP {publicip}, Internal IP {internalip}. Please see the attached CSV file.""".format(machinename=devicename, publicip=pubip,internalip=prvip)
     return emailbody
 
 
-def make_csv(q):
-    messagestring = """pk,date,devicename,upload,download,ping\n"""
-    for rec in q:
-        dt = ""
-        if (useutc):
-            dt = datetime.datetime.utcfromtimestamp(rec.date)
-        else:
-            dt = datetime.datetime.fromtimestamp(rec.date).strftime('%Y-%m-%d %H:%M:%S %z')
-        messagestring += ",{date},{devicename},{upload},{download},{ping}\n".format(
-            date=dt,
-            devicename=devicename,
-            upload=rec.upload,
-            download=rec.download,
-            ping=rec.ping
-        )
-    return messagestring
-
-def send_results_email(sess):
-    try:
-        u = sess.query(TestResult).filter(TestResult.sent==False).all()
-        send_an_email(
-        "Speed Test Results from {today} from {devicename}".format(devicename=devicename, today=datetime.date.today()),
-        make_email_body(u),
-        make_csv(u)
-        )
-        mark_all_as_sent(sess)
-    except Exception as e:
-        print('results not sent today')
-        print(e)
+def write_batch(sess, batch, sink):
+    """Streams the results in an outbox batch to a binary sink in export_format"""
+    import export
+    from models import batch_rows
+    export.write_export(batch_rows(sess, batch), sink, export_format, devicename, useutc)
 
-def mark_all_as_sent(sess):
-    try:
-        u = sess.query(TestResult).filter(TestResult.sent==False).all()
-        for x in u:
-            x.sent = True 
-        sess.commit()
-    except Exception as e:
-        print('Could not clear records')
-        print(e)
+def email_batch(sess, batch):
+    send_an_email(
+    "Speed Test Results from {today} from {devicename} ({batch})".format(devicename=devicename, today=datetime.date.today(), batch=batch.batch_id),
+    make_email_body(),
+    write_attachment=lambda sink: write_batch(sess, batch, sink),
+    attachment_format=export_format
+    )
 
 
 @contextlib.contextmanager
 def scp_connection(*args, **kwargs):
     """Uses the SCP library to create an SCP connection. Same param as paramiko.SSHClient.connect()"""
+    from paramiko import SSHClient
+    from paramiko.client import AutoAddPolicy
+    from scp import SCPClient
     sshuser, sshpass = get_ssh_creds()
     client = SSHClient()
     client.load_system_host_keys()
@@ -243,85 +424,384 @@ def timenow():
 def upload_dir():
     return scp_dir # path.join(scp_dir, devicename)
 
-def upload_name():
-    return "{time}_FROM_{devicename}.csv".format(devicename=devicename,time=timenow())
+def upload_name(batch_id):
+    # Named after the batch rather than the time, so that a batch sent again replaces its first upload
+    return "{batch}_FROM_{devicename}.{ext}".format(devicename=devicename,batch=batch_id,ext=export_format)
 
-def upload_path():
-    return path.join(upload_dir(), upload_name())
+def upload_path(batch_id):
+    return path.join(upload_dir(), upload_name(batch_id))
 
 def make_log_string():
-    return "upload from {pubip}/{prvip} at {timeat}".format(pubip=get_public_ip(), prvip=get_internal_ip(), timeat=timenow())
+    identity = get_identity()
+    return "upload from {pubip}/{prvip} at {timeat}".format(pubip=identity.public_ip(), prvip=identity.internal_ip(), timeat=timenow())
 
-def log_path():
-    return path.join(upload_dir(), "log_{time}_{devicename}.log".format(time=timenow(), devicename=devicename))
+def log_path(batch_id):
+    return path.join(upload_dir(), "log_{batch}_{devicename}.log".format(batch=batch_id, devicename=devicename))
 
-def upload_via_scp(conn):
+def upload_batch(sess, batch):
+    import export
     u,p = get_ssh_creds()
+    with scp_connection(scp_host, username=u, password=p) as c, export.spool() as results_file:
+        print(c)
+        print(upload_path(batch.batch_id))
+        write_batch(sess, batch, results_file)
+        results_file.seek(0)
+        log_file = BytesIO(make_log_string().encode('utf-8'))
+        c.putfo(results_file, upload_path(batch.batch_id))
+        c.putfo(log_file, log_path(batch.batch_id))
+
+def get_sftp_sink():
+    global sftp_sink
+    if sftp_sink is None:
+        from sftpsink import SFTPSink
+        u, p = get_ssh_creds()
+        sftp_sink = SFTPSink(scp_host, u, p, scp_dir, devicename, export_format, useutc)
+    return sftp_sink
+
+def get_outbox(sess):
+    """The outbox.Outbox for the sinks configured by the command line, made on first use"""
+    global outbox
+    if outbox is None:
+        from models import session_factory
+        from outbox import Outbox
+        outbox = Outbox(session_factory(sess))
+        if (scp_host and scp_dir):
+            if (sftp_append):
+                outbox.add('sftp', get_sftp_sink().send, sftp_batch, sftp_max_wait)
+            else:
+                outbox.add('scp', upload_batch)
+        if (to_email):
+            outbox.add('email', email_batch)
+    return outbox
+
+def measured_values(records, metric):
+    # Leaves out failed tests and the null() speeds of ping-only ones
+    return [v for v in (getattr(r, metric) for r in records) if isinstance(v, (int, float)) and v > 0]
+
+class Convergence(object):
+    """The results of a -cv/--converge run so far, by target, and whether they pin down the means well enough to stop"""
+
+    def __init__(self, ping_only, probes=()):
+        self.ping_only = ping_only
+        self.probes = set(probes)
+        self.records = {} # target: [TestResult]
+        self.started = time.time()
+        self.iterations = 0
+
+    def add(self, records):
+        self.iterations += 1
+        for record in records:
+            self.records.setdefault(getattr(record, 'target', None), []).append(record)
+
+    def metrics(self, target):
+        return ('ping',) if self.ping_only or target in self.probes else ('ping', 'download', 'upload')
+
+    def bounds(self, target):
+        """{metric: (mean, error)} for target, None where no test of the metric succeeded"""
+        bounds = {}
+        for metric in self.metrics(target):
+            values = measured_values(self.records[target], metric)
+            bounds[metric] = pyspeedtest.confidence_interval(values) if values else None
+        return bounds
+
+    def converged(self, target):
+        if self.iterations < converge_min_iterations:
+            return False
+        for bound in self.bounds(target).values():
+            if bound is None or bound[1] is None or bound[1] > bound[0] * converge_percent / 100:
+                return False
+        return True
+
+    def done(self):
+        elapsed = time.time() - self.started
+        if converge_max_time is not None and elapsed + elapsed / self.iterations > converge_max_time:
+            return True
+        return all(self.converged(target) for target in self.records)
+
+    def save(self, sess):
+        """Prints the error bounds and, with the full database layer, stores a TestRun per target that the results link to"""
+        for target, records in self.records.items():
+            bounds = self.bounds(target)
+            converged = self.converged(target)
+            print("{status} after {amt} tests{target}: {bounds}".format(status='Converged' if converged else 'Stopped', amt=self.iterations, target=' of {}'.format(target) if target else '',
+                                                                        bounds=', '.join('{}={} +/- {}'.format(metric, round(bound[0], 2), '?' if bound[1] is None else round(bound[1], 2)) for metric, bound in sorted(bounds.items()) if bound is not None)))
+            if isinstance(sess, fastdb.FastSession):
+                continue
+            from models import TestRun
+            run = TestRun(date=self.started, seconds=time.time() - self.started, target=target, iterations=self.iterations, converged=converged)
+            for metric, bound in bounds.items():
+                if bound is not None:
+                    setattr(run, metric + '_mean', bound[0])
+                    setattr(run, metric + '_error', bound[1])
+            sess.add(run)
+            sess.flush()
+            for record in records:
+                record.run_id = run.id
+
+def run_tests(sess, choice=None, pool=None, ping_only=None, verbose=False):
+    """Runs times_to_take_test tests, or fewer if converge_percent is set and they agree, and commits them. Chooses a
+    server if one isn't given. Returns the server choice"""
+    if ping_only is None:
+        ping_only = pingtest
+    if converge_percent:
+        print("Testing internet speed until it is known within {}%, at most {} times".format(converge_percent, times_to_take_test))
+    else:
+        print("Testing internet speed {} times".format(times_to_take_test))
+    if choice is None and not (uptest and ping_only) and not test_targets:
+        try:
+            choice = choose_server(sess)
+        except Exception as e:
+            print("Could not choose a speedtest server")
+            print(e)
+    targets = target_list(choice, ping_only)
+    convergence = Convergence(ping_only, [target_tag(kind, host) for kind, host in targets if kind == 'probe']) if converge_percent else None
+    for x in range(times_to_take_test):
+        if targets:
+            records = record_target_tests(sess, targets, pool, ping_only)
+            for r in records:
+                if (verbose):
+                    print("Test {amt} {target}: ping={ping}, download={download}, upload={upload}".format(amt=x+1, target=r.target, ping=r.ping, download=r.download, upload=r.upload))
+        else:
+            r = record_speed_test(sess, choice, pool, ping_only)
+            records = [r] if r is not None else []
+            if (verbose):
+                if r is None:
+                    print("Test {amt} didn't complete".format(amt=x+1))
+                else:
+                    print("Test {amt}: ping={ping}, download={download}, upload={upload}".format(amt=x+1, ping=r.ping, download=r.download, upload=r.upload))
+        if convergence is not None:
+            convergence.add(records)
+            if convergence.done():
+                break
+    if convergence is not None:
+        convergence.save(sess)
+    sess.commit()
+    print("Testing done")
+    return choice
+
+def deliver_results(sess):
+    """Sends results to the email and SCP/SFTP sinks at the same time, each picking up where it last left off"""
+    if not (to_email or (scp_host and scp_dir)):
+        return
+    sess.commit()
+    get_identity(sess).prefetch()
+    get_outbox(sess).deliver()
+    count_backlog(sess)
+
+def count_backlog(sess):
+    """Sets the delivery backlog of the live metrics from the database, which scrapes then read from memory"""
+    if live_metrics is None or isinstance(sess, fastdb.FastSession):
+        return
+    from models import TestResult
+    live_metrics.set_backlog(sess.query(TestResult).filter(TestResult.sent == False).count())
+
+def start_metrics(sess, port):
+    """Serves the live metrics on port in the background"""
+    global live_metrics
+    from metrics import Metrics, MetricsServer
+    live_metrics = Metrics(devicename)
+    count_backlog(sess)
+    MetricsServer(live_metrics, port).start()
+    print("Serving metrics on port {}".format(port))
+
+def maintain_history(sess):
+    """Adds new results to the hourly/daily rollups, then applies the retention settings"""
+    import rollups
     try:
-        res = sess.query(TestResult).filter(TestResult.sent==False).all()
-        with scp_connection(scp_host, username=u, password=p) as c:
-            print(c)
-            print(upload_dir())
-            print(upload_name())
-            print(upload_path())
-            csv = make_csv(res)
-            csv_file = StringIO(csv)
-            log_file = StringIO(make_log_string())
-            c.putfo(csv_file, upload_path())
-            c.putfo(log_file, log_path())
-            mark_all_as_sent(sess)
-            pass
+        new = rollups.update_rollups(sess, useutc)
+        deleted = rollups.compact(sess, raw_retention_days, hourly_retention_days, useutc)
+        if (new or deleted):
+            print("Rolled up {} results, deleted {} old ones".format(new, deleted))
     except Exception as e:
-        print('results not dumped today')
+        print('Could not update rollups')
         print(e)
-        raise e
-    print(scp_host)
-    print(scp_dir)
+
+def print_report(sess, period, days):
+    """Prints the hourly or daily rollups of the last days days"""
+    import export
+    import rollups
+    rollups.update_rollups(sess, useutc)
+    since = rollups.period_start(time.time() - days * 24 * 60 * 60, period, useutc)
+    rows = rollups.rollups(sess, period, since)
+    if len(set(r.target for r in rows)) > 1:
+        export.write_target_table(rows, sys.stdout, period, useutc)
+    else:
+        export.write_rollup_table(rows, sys.stdout, period, useutc)
+
+def run_daemon(sess, test_schedule, ping_schedule=None, deliver_schedule=None, jitter=0, verbose=False, rollup_schedule=None):
+    """Runs tests and deliveries on their schedules until SIGTERM/SIGINT, keeping the database session and connections
+    between runs. Each test goes through choose_server(), so a public IP or location change is noticed on the next test"""
+    sched = scheduler.Scheduler()
+    pool = None if cold_connections else pyspeedtest.ConnectionPool()
+
+    def speed_test():
+        run_tests(sess, None, pool, pingtest, verbose)
+
+    def ping_test():
+        choice = None if (uptest or test_targets) else choose_server(sess)
+        targets = target_list(choice, True)
+        records = record_target_tests(sess, targets, pool, True) if targets else [record_speed_test(sess, choice, pool, ping_only=True)]
+        sess.commit()
+        if (verbose):
+            for record in records:
+                print("Ping: {}".format(record.ping) if record.target is None else "Ping {}: {}".format(record.target, record.ping))
+
+    sched.add('speed test', scheduler.parse_schedule(test_schedule), speed_test, jitter)
+    if ping_schedule:
+        sched.add('ping test', scheduler.parse_schedule(ping_schedule), ping_test, jitter)
+    if deliver_schedule:
+        sched.add('delivery', scheduler.parse_schedule(deliver_schedule), lambda: deliver_results(sess), jitter)
+    if rollup_schedule:
+        sched.add('rollup', scheduler.parse_schedule(rollup_schedule), lambda: maintain_history(sess))
+
+    def shutdown(signum, frame):
+        print("Stopping after signal {}".format(signum))
+        sched.stop()
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    for job in sched.jobs:
+        print("Scheduled {} {}".format(job.name, job.schedule))
+    try:
+        sched.run()
+    finally:
+        if pool:
+            pool.close()
+        if sftp_sink:
+            sftp_sink.close()
+        sess.commit()
+        sess.close()
+    print("Daemon stopped")
 
 def init_db():
-    engine = create_engine('sqlite:///db.sqlite')
-    Base.metadata.create_all(engine)
-    DBSession = sessionmaker(bind=engine)
-    return DBSession()
+    import models
+    return models.init_db('sqlite:///db.sqlite')
+
+def init_fast_db():
+    """Session that records results without loading SQLAlchemy, falling back to init_db() on a new database"""
+    try:
+        return fastdb.FastSession('db.sqlite')
+    except Exception:
+        return init_db()
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support() # Needed for -pr/--processes in a pyinstaller build
     parser  = argparse.ArgumentParser(description=' Tests the internet, stores results and sends out results. The environment variables "TESTUSER" and "TESTPASS" must be set to the email and password of the gmail account that will be used to send reesults. If no arguments are supplied, the script is ran as ./script -t -a')
     parser.add_argument('-t', '--test', help='Run a speed test, and store it', action="store_true")
     parser.add_argument('-p', '--ping', help='Run a ping test, and store it. -t/--test is ignored when using this command. Up/Down speed is recorded as NULL for this test.', action="store_true")
-    parser.add_argument('-up', '--unixping', help='Domain to ping, using the system ping command. Does not work on Windows', type=str)
+    parser.add_argument('-up', '--unixping', help='Domain (or domain:port) to measure latency to instead of the speedtest server. See -pm/--probemode. A comma separated list measures each one separately, see -tg/--targets', type=str)
+    parser.add_argument('-pm', '--probemode', choices=('tcp', 'udp', 'system'), help='How to measure latency to -up/--unixping: time TCP connects (default, port 80 unless given), UDP echo requests (port 7 unless given), or run the system ping command, which does not work on Windows')
+    parser.add_argument('-pc', '--probecount', type=int, help='Number of latency probes per test (default 10). Min, p95, jitter and loss are stored along with the average')
+    parser.add_argument('-pi', '--probeinterval', type=float, help='Seconds between latency probes (default 0.2)')
     parser.add_argument('-e', '--email', help='Email to which to send the unsent results. If no email is provided, results will be cached and sent next time an address is provided.')
-    parser.add_argument('-i', '--iterations', type=int, help='Number of times to take the test (default 5)')
+    parser.add_argument('-i', '--iterations', type=int, help='Number of times to take the test (default 5). The most to take with -cv/--converge')
+    parser.add_argument('-cv', '--converge', type=float, help='Stop taking tests early once the 95%% confidence interval of the mean ping, download and upload is within this percent of the mean, after at least 3 tests. The number of tests and the error bounds are stored in the testruns table')
+    parser.add_argument('-mt', '--maxtime', type=int, help='With -cv/--converge, stop before a test that would take the run over this many seconds')
     parser.add_argument('-n', '--name', help='Name of the system to use when sending an email (defaults to the hostname of the machine)')
     parser.add_argument('-v', '--verbose', help='Display the speed test results as they are collected (defaults to false, and status messages are printed regardless.', action="store_true")
     parser.add_argument('-u', '--utc', help='Sends the results with utc time. Default is to use the timezone of the host machine', action="store_true")
     parser.add_argument('-s', '--scphost', help='Uploads the results to a location over SSH', type=str)
     parser.add_argument('-d', '--directory', help='The path of directory on the SCP host machine in which to put the report file and logs', type=str)
+    parser.add_argument('-st', '--serverttl', type=int, help='Seconds to reuse the chosen speedtest server before choosing again (default 86400). The server is also chosen again if the public IP or location changes')
+    parser.add_argument('-du', '--duration', type=int, help='Seconds to keep each download and upload running, growing the transfer size as it goes. Speeds are reported for the steady state after the first transfers. Default is to transfer a fixed set of files')
+    parser.add_argument('-ms', '--maxstreams', type=int, help='Keep doubling the number of parallel connections, up to this many, while the download/upload speed still improves. The number used is stored with each result. Default is 2 connections')
+    parser.add_argument('-pt', '--phasetimes', help='Store how long DNS, connecting, waiting for the first byte and transferring took for every connection of every test', action="store_true")
+    parser.add_argument('-sw', '--skipwarmup', help='Report the steady-state download/upload speed, leaving out the TCP slow start at the beginning of each test', action="store_true")
+    parser.add_argument('-en', '--engine', choices=('thread', 'asyncio'), help='Run the speed test connections on threads (default) or with asyncio, which scales better to many streams. -du/--duration and -pt/--phasetimes always use threads')
+    parser.add_argument('-pr', '--processes', type=int, help='Spread the download/upload connections over this many processes, so fast links aren\'t limited by one CPU core (default 1)')
+    parser.add_argument('-cc', '--coldconnections', help='Open new connections for every ping, download and upload, so that connection setup is part of what is measured. Default is to reuse connections across tests and iterations', action="store_true")
+    parser.add_argument('-dm', '--daemon', help='Keep running, taking tests and sending results on the schedules below, until stopped with SIGTERM or Ctrl-C. Replaces running the script from cron', action="store_true")
+    parser.add_argument('-ts', '--testschedule', default='1h', help='With -dm/--daemon, when to run the speed test (-i/--iterations times). Either an interval like 30s, 5m, 1h, 1d or a cron spec like "0 7 * * *" (default 1h)')
+    parser.add_argument('-ps', '--pingschedule', help='With -dm/--daemon, when to run a ping-only test, for sampling latency more often than speed (default never)')
+    parser.add_argument('-ds', '--deliverschedule', help='With -dm/--daemon, when to send unsent results by email/SCP (default never)')
+    parser.add_argument('-j', '--jitter', type=float, default=0, help='With -dm/--daemon, add up to this many random seconds to every scheduled run, so that devices on the same schedule don\'t all test at once (default 0)')
+    parser.add_argument('-xf', '--exportformat', choices=('csv', 'csv.gz', 'csv.zst', 'col', 'col.gz', 'col.zst'), help='Format of the results sent by email or SCP: csv (default), or col, a compact columnar binary format. Add .gz or .zst to compress, zst needs the zstandard package. export.py has readers for all of them')
+    parser.add_argument('-sf', '--sftp', help='With -s/--scphost, keep one SFTP connection open and append only the new results to a file per device per day in -d/--directory, instead of uploading a new file every time. Only csv export formats can be appended', action="store_true")
+    parser.add_argument('-sb', '--sftpbatch', type=int, help='With -sf/--sftp, wait until this many results are waiting before sending (default 1)')
+    parser.add_argument('-sm', '--sftpmaxwait', type=int, help='With -sf/--sftp, send waiting results anyway once the oldest is this many seconds old (default 3600)')
+    parser.add_argument('-it', '--ipttl', type=int, help='Seconds to reuse the public and internal IP in reports before looking them up again (default 3600). Reports never wait for the lookup once an IP is known. Changes are stored in the ipchanges table')
+    parser.add_argument('-rs', '--rollupschedule', default='1h', help='With -dm/--daemon, when to add new results to the hourly/daily rollups and delete old ones (default 1h). Other runs do it after testing')
+    parser.add_argument('-rr', '--rawretention', type=int, help='Days of raw results to keep. Older days are deleted once all their results are in the rollups and have been delivered by email or SCP, so nothing is deleted without -e/--email or -s/--scphost. Default is to keep everything')
+    parser.add_argument('-hr', '--hourlyretention', type=int, help='Days of hourly rollups to keep. Daily rollups are kept forever. Default is to keep everything')
+    parser.add_argument('-rp', '--report', choices=('hour', 'day'), help='Print the hourly or daily count, mean and percentiles of ping, download and upload from the rollups')
+    parser.add_argument('-rd', '--reportdays', type=int, help='Days covered by -rp/--report (default 2 for hour, 90 for day)')
+    parser.add_argument('-tg', '--targets', help='Comma separated speedtest servers (host:port) to test on every iteration instead of choosing one. Each gets its own result, tagged with the target, and -rp/--report compares them side by side. -up/--unixping targets are measured too, as ping-only results', type=str)
+    parser.add_argument('-tm', '--targetmode', choices=('staggered', 'together'), help='With several targets, staggered (default) measures all the pings at once, then runs each target\'s download and upload in turn so they don\'t compete for the link. together tests every target at the same time')
+    parser.add_argument('-mp', '--metricsport', type=int, help='Serve live metrics in the Prometheus text format on this port while running, mostly useful with -dm/--daemon: the latest and recent mean ping/download/upload, ping and test duration histograms, failure counts and the number of results waiting for delivery')
+    parser.add_argument('-f', '--fast', help='Start faster by storing results without loading the full database layer. Ignored with -dm/--daemon, -e/--email, -s/--scphost, -rp/--report, -mp/--metricsport or -cv/--converge, which need it anyway', action="store_true")
     args = parser.parse_args()
-    sess = init_db()
+    if (args.sftp and args.exportformat and args.exportformat.split('.')[0] != 'csv'):
+        parser.error('-sf/--sftp can only append csv export formats, not {}'.format(args.exportformat))
+    if (args.fast and not (args.daemon or args.email or args.scphost or args.report or args.metricsport or args.converge)):
+        sess = init_fast_db()
+    else:
+        sess = init_db()
     print(sys.argv)
     useutc = args.utc
     pingtest = args.ping
+    record_phases = args.phasetimes
+    cold_connections = args.coldconnections
+    skip_warmup = args.skipwarmup
+    if (args.engine):
+        test_engine = args.engine
+    if (args.processes):
+        test_processes = args.processes
     uptest = args.unixping
+    if (args.probemode):
+        probe_mode = args.probemode
+    if (args.probecount):
+        probe_count = args.probecount
+    if (args.probeinterval is not None):
+        probe_interval = args.probeinterval
     if (args.name):
         devicename = args.name
     if (args.iterations):
         times_to_take_test = args.iterations
-    if (args.test or args.ping or args.unixping or len(sys.argv) == 1):
-        print("Testing internet speed {} times".format(times_to_take_test))
-        for x in range(times_to_take_test):
-            r = record_speed_test(sess)
-            if (args.verbose or not sys.argv):
-                print("Test {amt}: ping={ping}, download={download}, upload={upload}".format(amt=x+1, ping=r.ping, download=r.download, upload=r.upload))
-        sess.commit()
-        print("Testing done")
+    if (args.converge):
+        converge_percent = args.converge
+    if (args.maxtime):
+        converge_max_time = args.maxtime
+    if (args.duration):
+        test_duration = args.duration
+    if (args.maxstreams):
+        max_streams = args.maxstreams
+    if (args.serverttl is not None):
+        server_cache_ttl = args.serverttl
+    if (args.ipttl is not None):
+        ip_cache_ttl = args.ipttl
     if (args.scphost and args.directory):
         scp_host = args.scphost
         scp_dir = args.directory
-        upload_via_scp(sess)
-        
     if (args.email):
         to_email = args.email
-        print("Sending test results to {}".format(to_email))
-        send_results_email(sess)
-        print("Sending done")
-
+    if (args.exportformat):
+        export_format = args.exportformat
+    sftp_append = args.sftp
+    if (args.sftpbatch):
+        sftp_batch = args.sftpbatch
+    if (args.sftpmaxwait is not None):
+        sftp_max_wait = args.sftpmaxwait
+    if (args.rawretention is not None):
+        raw_retention_days = args.rawretention
+    if (args.hourlyretention is not None):
+        hourly_retention_days = args.hourlyretention
+    if (args.targets):
+        test_targets = [t.strip() for t in args.targets.split(',') if t.strip()]
+    if (args.targetmode):
+        target_mode = args.targetmode
+    if (args.metricsport):
+        metrics_port = args.metricsport
+        start_metrics(sess, metrics_port)
+    if (args.daemon):
+        run_daemon(sess, args.testschedule, args.pingschedule, args.deliverschedule, args.jitter, args.verbose, args.rollupschedule)
+        sys.exit(0)
+    if (args.test or args.ping or args.unixping or len(sys.argv) == 1):
+        pool = None if cold_connections else pyspeedtest.ConnectionPool()
+        run_tests(sess, pool=pool, verbose=args.verbose or not sys.argv)
+        if pool:
+            pool.close()
+        if not isinstance(sess, fastdb.FastSession):
+            maintain_history(sess)
+    if (args.report):
+        print_report(sess, args.report, args.reportdays or (2 if args.report == 'hour' else 90))
+    deliver_results(sess)
@@ -0,0 +1,72 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import models
+import rollups
+
+day = 24 * 60 * 60
+
+
+class CompactTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.sess = models.init_db('sqlite:///' + os.path.join(self.workdir, 'db.sqlite'))
+
+    def tearDown(self):
+        self.sess.close()
+        shutil.rmtree(self.workdir)
+
+    def add_day(self, start, count, sent):
+        for i in range(count):
+            self.sess.add(models.TestResult(date=start + i * 600, ping=20, download=50, upload=5, sent=sent))
+        self.sess.commit()
+
+    def count(self, *criteria):
+        return self.sess.query(models.TestResult).filter(*criteria).count()
+
+    def test_keeps_unsent_results_without_watermarks(self):
+        old = rollups.period_start(time.time() - 30 * day, 'day') + 60 * 60
+        self.add_day(old, 30, sent=True)
+        self.add_day(old + day, 20, sent=False)
+        rollups.update_rollups(self.sess)
+        self.assertEqual(self.sess.query(models.Watermark).filter(models.Watermark.sink != rollups.watermark_name).count(), 0)
+
+        deleted = rollups.compact(self.sess, raw_days=10)
+
+        self.assertEqual(deleted, 30)
+        self.assertEqual(self.count(models.TestResult.sent == False), 20)
+        self.assertEqual(self.count(), 20)
+
+    def test_keeps_results_not_rolled_up(self):
+        old = rollups.period_start(time.time() - 30 * day, 'day') + 60 * 60
+        self.add_day(old, 10, sent=True)
+
+        self.assertEqual(rollups.compact(self.sess, raw_days=10), 0)
+        self.assertEqual(self.count(), 10)
+
+
+class StatsTest(unittest.TestCase):
+    def test_leaves_out_failed_results(self):
+        rollup = models.Rollup()
+        rollups.set_stats(rollup, 'download', [50, 0, None, 70])
+        self.assertEqual(rollup.download_count, 2)
+        self.assertEqual(rollup.download_min, 50)
+        self.assertEqual(rollup.download_mean, 60)
+
+    def test_merge_leaves_out_failed_results(self):
+        rollup = models.Rollup()
+        rollups.set_stats(rollup, 'ping', [20, 40])
+        rollups.merge_stats(rollup, 'ping', [0, 0, 30])
+        self.assertEqual(rollup.ping_count, 3)
+        self.assertEqual(rollup.ping_min, 20)
+        self.assertEqual(rollup.ping_mean, 30)
+
+
+if __name__ == '__main__':
+    unittest.main()